@@ -0,0 +1,267 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import main
+
+# Pacote MPEG-TS nulo (PID 0x1FFF): o ffmpeg ignora, então serve para inflar os segmentos
+# até o tamanho pedido sem invalidar o vídeo
+NULL_PACKET = b"\x47\x1f\xff\x10" + b"\xff" * 184
+VARIANTS = (("1080p", "1920x1080", 5000000), ("720p", "1280x720", 2500000), ("480p", "854x480", 1200000))
+SCENARIOS = ("engines", "panda", "cdn", "downloader")
+
+
+def pad_segment(data: bytes, size: int) -> bytes:
+    missing = size - len(data)
+    if missing <= 0:
+        return data
+    return data + NULL_PACKET * -(-missing // len(NULL_PACKET))
+
+
+def build_segments(count: int, duration: float, size: int, workdir: Path):
+    # Com ffmpeg disponível gera vídeo real (testsrc em mpeg2video, sem dependências extras)
+    # para que o remux também seja medido; sem ele, segmentos só com pacotes nulos
+    if shutil.which("ffmpeg"):
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+             "-f", "lavfi", "-i", f"testsrc=size=320x180:rate=10:duration={count * duration}",
+             "-c:v", "mpeg2video", "-g", str(max(1, int(duration * 10))),
+             "-f", "segment", "-segment_time", str(duration), "-segment_format", "mpegts",
+             str(workdir / "seg%05d.ts")],
+            stderr=subprocess.DEVNULL,
+        )
+        files = sorted(workdir.glob("seg*.ts"))[:count]
+        if len(files) == count:
+            return [pad_segment(path.read_bytes(), size) for path in files], True
+    return [pad_segment(b"", size) for _ in range(count)], False
+
+
+def serve(port: int, segments: list, duration: float, latency: float, jitter: float, error_rate: float, ready):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status: int, body: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+            parts = self.path.strip("/").split("/")
+            video_id, name = parts[0], parts[-1]
+
+            if name == "playlist.m3u8":
+                lines = ["#EXTM3U"]
+                for folder, resolution, bandwidth in VARIANTS:
+                    lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={resolution}")
+                    lines.append(f"{folder}/video.m3u8")
+                return self._send(200, ("\n".join(lines) + "\n").encode(), "application/vnd.apple.mpegurl")
+
+            if name == "video.m3u8":
+                # O Panda publica URIs absolutas; o CDN, relativas à pasta da variante
+                prefix = f"http://{self.headers['Host']}/{video_id}/{parts[1]}/" if video_id.startswith("panda") else ""
+                lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(duration + 1)}",
+                         "#EXT-X-MEDIA-SEQUENCE:0"]
+                for index in range(len(segments)):
+                    lines.append(f"#EXTINF:{duration:.3f},")
+                    lines.append(f"{prefix}seg{index:05d}.ts")
+                lines.append("#EXT-X-ENDLIST")
+                return self._send(200, ("\n".join(lines) + "\n").encode(), "application/vnd.apple.mpegurl")
+
+            if name.startswith("seg") and name.endswith(".ts"):
+                if random.random() < error_rate:
+                    return self._send(503, b"", "text/plain")
+                index = int(name[3:-3])
+                if index < len(segments):
+                    return self._send(200, segments[index], "video/mp2t")
+
+            self._send(404, b"", "text/plain")
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 1024
+
+    server = Server(("127.0.0.1", port), Handler)
+    ready.set()
+    server.serve_forever()
+
+
+class ResourceSampler:
+    # Amostra em segundo plano o número de threads do processo (as do ffmpeg ficam de fora)
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _threads() -> int:
+        try:
+            for line in Path("/proc/self/status").read_text().splitlines():
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+        except OSError:
+            pass
+        return threading.active_count()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, self._threads())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def point_at(provider, base: str):
+    provider.scheme, provider.domain = base.split("://")
+
+
+def run_scenario(name: str, args, base: str, results):
+    # Cada cenário roda em um processo próprio para que o pico de RSS seja só dele
+    workdir = Path(tempfile.mkdtemp(prefix="bench-"))
+    os.chdir(workdir)
+    main.HLS_MODE = args.mode
+    main.SEGMENT_ENGINE = args.engine
+    main.CONCURRENCY.state_path = workdir / "concurrency.json"
+    rows = []
+
+    with ResourceSampler() as sampler:
+        if name == "engines":
+            urls = [f"{base}/cdn-bench/1080p/seg{index:05d}.ts" for index in range(args.segments)]
+
+            def discard(index, data):
+                pass
+
+            def fetch(url):
+                response = main.HTTP_POOL.session_for(url).get(url)
+                response.raise_for_status()
+                return response.content
+
+            engines = [("fetch/threads", lambda: main.SegmentStreamer("", args.threads)._feed_threads(urls, fetch, discard))]
+            if main.aiohttp is not None:
+                engine = main.AsyncSegmentFetcher({})
+                window = max(main.STREAM_WINDOW, main.ASYNC_LOOP.per_host)
+                engines.append(("fetch/asyncio", lambda: engine.fetch_ordered(urls, window, discard)))
+            for label, run in engines:
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                started = time.perf_counter()
+                error = run()
+                seconds = time.perf_counter() - started
+                after = resource.getrusage(resource.RUSAGE_SELF)
+                cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+                rows.append({"scenario": label, "ok": error is None, "seconds": seconds, "segments": args.segments,
+                             "bytes": args.segments * args.size, "retries": 0, "cpu_seconds": cpu})
+        else:
+            metrics = main.LessonMetrics("bench", name)
+            save_path = str(workdir / f"{name}.mp4")
+            if name == "downloader":
+                downloader = main.VideoDownloader("panda-bench", save_path, args.threads, metrics=metrics)
+                for provider in downloader.providers.values():
+                    point_at(provider, base)
+            else:
+                downloader = main.HLSVideo(name, f"{name}-bench", save_path, args.threads)
+                downloader.metrics = metrics
+                point_at(downloader, base)
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            started = time.perf_counter()
+            try:
+                downloader.download()
+            except Exception as e:
+                print(f"{name}: {e}")
+            seconds = time.perf_counter() - started
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            rows.append({
+                "scenario": name, "ok": os.path.exists(save_path), "seconds": seconds, "segments": metrics.segments,
+                "bytes": metrics.bytes, "retries": metrics.retries,
+                "cpu_seconds": (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+            })
+
+    for row in rows:
+        row["segments_s"] = row["segments"] / row["seconds"] if row["seconds"] else 0.0
+        row["mb_s"] = row["bytes"] / row["seconds"] / 1e6 if row["seconds"] else 0.0
+        row["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        row["peak_threads"] = sampler.peak_threads
+    shutil.rmtree(workdir, ignore_errors=True)
+    results.put(rows)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Benchmark dos downloaders contra um servidor HLS sintético local")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"lista separada por vírgula de {', '.join(SCENARIOS)}")
+    parser.add_argument("--segments", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256 * 1024, help="tamanho de cada segmento em bytes")
+    parser.add_argument("--duration", type=float, default=4.0, help="duração declarada (EXTINF) de cada segmento")
+    parser.add_argument("--latency", type=float, default=0.05, help="latência artificial por requisição (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="variação aleatória da latência (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fração de segmentos respondidos com 503")
+    parser.add_argument("--threads", type=int, default=main.SEGMENT_THREADS_MAX)
+    parser.add_argument("--mode", default=main.HLS_MODE, choices=("stream", "temp"))
+    parser.add_argument("--engine", default=main.SEGMENT_ENGINE, choices=("threads", "asyncio"))
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--json", help="também grava os resultados neste arquivo JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-media-") as media_dir:
+        segments, real_media = build_segments(args.segments, args.duration, args.size, Path(media_dir))
+    if not real_media:
+        print("Sem ffmpeg para gerar vídeo: segmentos sintéticos, o remux vai falhar e só o download é medido")
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve,
+        args=(args.port, segments, args.duration, args.latency, args.jitter, args.error_rate, ready),
+        daemon=True,
+    )
+    server.start()
+    ready.wait()
+    base = f"http://127.0.0.1:{args.port}"
+
+    print(
+        f"{args.segments} segmentos de {len(segments[0])} bytes, latência {args.latency * 1000:.0f}±{args.jitter * 1000:.0f} ms, "
+        f"erros {args.error_rate:.0%}, modo {args.mode}, motor {args.engine}\n"
+    )
+    print(f"{'cenário':<15} {'ok':<4} {'tempo':>8} {'seg/s':>9} {'MB/s':>8} {'CPU':>7} {'RSS pico':>10} {'threads':>8} {'tentativas':>11}")
+    all_rows = []
+    try:
+        for name in filter(None, (item.strip() for item in args.scenarios.split(","))):
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_scenario, args=(name, args, base, results))
+            process.start()
+            rows = results.get()
+            process.join()
+            for row in rows:
+                all_rows.append(row)
+                print(
+                    f"{row['scenario']:<15} {'sim' if row['ok'] else 'não':<4} {row['seconds']:>7.2f}s {row['segments_s']:>9.1f} "
+                    f"{row['mb_s']:>8.1f} {row['cpu_seconds']:>6.2f}s {row['peak_rss_mb']:>7.1f} MB {row['peak_threads']:>8} "
+                    f"{row['retries']:>11}"
+                )
+    finally:
+        server.terminate()
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({"args": vars(args), "results": all_rows}, indent=2))
+
+
+if __name__ == "__main__":
+    main_bench()
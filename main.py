@@ -1,25 +1,138 @@
+import argparse
+import asyncio
+import atexit
+import bisect
+import collections
+import contextlib
+import csv
+import functools
+import hashlib
 import json
+import multiprocessing
 import os
 import pickle
 import queue
 import random
 import re
+import shutil
+import sqlite3
+import subprocess
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Optional
-from urllib.parse import parse_qs
-from datetime import datetime
+from urllib.parse import parse_qs, urljoin, urlparse
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 import m3u8
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:  # opcional, só necessário com SEGMENT_ENGINE=asyncio
+    aiohttp = None
 
 BASE_API = "https://skylab-api.rocketseat.com.br"
 BASE_URL = "https://app.rocketseat.com.br"
 SESSION_PATH = Path(os.getenv("SESSION_DIR", ".")) / ".session.pkl"
 SESSION_PATH.parent.mkdir(exist_ok=True)
 
+# Cache das respostas da API (catálogo, jornadas e clusters)
+METADATA_DIR = SESSION_PATH.parent / "metadata"
+METADATA_TTL = int(os.getenv("METADATA_TTL", str(6 * 3600)))
+# Com OFFLINE=1 só o cache é usado, sem nenhuma chamada à API
+OFFLINE = os.getenv("OFFLINE", "0") == "1"
+
+# Store de vídeos por provedor + video_id: cada vídeo é baixado uma vez e ligado em todas as
+# aulas que o usam ("hardlink", "symlink" ou "copy"; cai para o próximo se o anterior falhar).
+# Fica dentro de Cursos para estar no mesmo sistema de arquivos das aulas (no Docker, a pasta
+# da sessão é outro bind mount e hardlink/rename entre os dois viraria cópia).
+STORE_DIR = Path(os.getenv("STORE_DIR", str(Path("Cursos") / ".store")))
+STORE_LINK = os.getenv("STORE_LINK", "hardlink")
+
+# Catálogo de formações guardado no índice local: dentro de CATALOG_TTL segundos a seleção
+# abre sem nenhuma requisição. As páginas são buscadas em paralelo, CATALOG_PAGE_SIZE itens cada.
+CATALOG_TTL = int(os.getenv("CATALOG_TTL", str(24 * 3600)))
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "60"))
+
+# Índice local das aulas já baixadas; com TRUST_INDEX=1 nem o tamanho do arquivo é conferido
+INDEX_PATH = SESSION_PATH.parent / "index.sqlite3"
+TRUST_INDEX = os.getenv("TRUST_INDEX", "0") == "1"
+# Processos do modo batch (python main.py --batch); cada um tem sua sessão, seus pipelines
+# e uma fração de BANDWIDTH_LIMIT
+BATCH_PROCESSES = int(os.getenv("BATCH_PROCESSES", str(min(4, os.cpu_count() or 1))))
+
+# Caminho opcional de um textfile do Prometheus com as métricas da execução, reescrito a
+# cada METRICS_INTERVAL segundos (ex: diretório do textfile collector do node_exporter)
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
+# Arquivo opcional de trace no formato Chrome/Perfetto (abra em ui.perfetto.dev ou
+# chrome://tracing), com um span por fase de cada aula: API, playlist, segmentos, ffmpeg,
+# ffprobe e materiais. No modo batch cada tarefa grava o seu, com o rótulo no nome.
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+# QUIET=1 tira do console as linhas por segmento; fica só o resumo de cada vídeo
+QUIET = os.getenv("QUIET", "0") == "1"
+
+# Quantidade de aulas baixadas ao mesmo tempo e teto global de conexões abertas
+# (somando os segmentos de todas as aulas em andamento)
+LESSON_WORKERS = int(os.getenv("LESSON_WORKERS", "3"))
+# Demais estágios do pipeline de aulas (metadados, remux e verificação) e tamanho das
+# filas entre eles: um estágio lento segura os anteriores em vez de acumular trabalho
+METADATA_WORKERS = int(os.getenv("METADATA_WORKERS", "2"))
+REMUX_WORKERS = int(os.getenv("REMUX_WORKERS", "2"))
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", "2"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+# Requisições simultâneas à API ao montar o plano de download (busca dos clusters)
+CLUSTER_FETCH_LIMIT = int(os.getenv("CLUSTER_FETCH_LIMIT", "4"))
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "30"))
+CONNECTION_SLOTS = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+# Workers de segmentos por aula: o controlador AIMD começa em SEGMENT_THREADS requisições
+# simultâneas por host e pode subir até SEGMENT_THREADS_MAX
+SEGMENT_THREADS = int(os.getenv("SEGMENT_THREADS", "10"))
+SEGMENT_THREADS_MAX = int(os.getenv("SEGMENT_THREADS_MAX", "32"))
+CONCURRENCY_STATE_PATH = SESSION_PATH.parent / "concurrency.json"
+
+# Novas tentativas por segmento, com backoff exponencial (RETRY_BACKOFF * 2^tentativa) e jitter
+SEGMENT_RETRIES = int(os.getenv("SEGMENT_RETRIES", "5"))
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", "0.5"))
+RETRY_BACKOFF_MAX = 60.0
+RETRY_STATUS = (403, 408, 429, 500, 502, 503, 504)
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "30"))
+
+# Teto de banda em bytes/s (aceita K, M e G; 0 = sem limite) e agenda opcional de
+# faixas de horário com limites próprios, ex: "08:00-19:00=2M,19:00-23:00=20M"
+BANDWIDTH_LIMIT = os.getenv("BANDWIDTH_LIMIT", "0")
+BANDWIDTH_SCHEDULE = os.getenv("BANDWIDTH_SCHEDULE", "")
+
+# "stream" envia os segmentos direto para o stdin do ffmpeg (nada fica salvo: uma execução
+# interrompida recomeça o vídeo do zero); "temp" usa a pasta .temp e retoma de onde parou
+HLS_MODE = os.getenv("HLS_MODE", "stream")
+# Staging do modo temp: o manifesto e o que não couber na memória ficam em STAGING_DIR (que
+# pode ser um tmpfs); os segmentos vão para STAGING_MEMORY_DIR enquanto o processo estiver
+# abaixo de STAGING_MEMORY_LIMIT (K/M/G; 0 = só disco)
+STAGING_DIR = Path(os.getenv("STAGING_DIR", ".temp"))
+STAGING_MEMORY_DIR = os.getenv("STAGING_MEMORY_DIR", "/dev/shm/rocketseat-staging" if os.path.isdir("/dev/shm") else "")
+STAGING_MEMORY_LIMIT = os.getenv("STAGING_MEMORY_LIMIT", "256M")
+# Quantos segmentos podem ficar em memória aguardando a vez de ir para o ffmpeg
+STREAM_WINDOW = int(os.getenv("STREAM_WINDOW", "32"))
+# "threads" (padrão) usa uma thread por worker; "asyncio" usa aiohttp em uma única thread
+SEGMENT_ENGINE = os.getenv("SEGMENT_ENGINE", "threads")
+ASYNC_HOST_LIMIT = int(os.getenv("ASYNC_HOST_LIMIT", "64"))
+# Tamanho dos blocos lidos da rede e gravados em disco: segmentos da pasta temporária e
+# materiais nunca ficam inteiros em memória
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", str(64 * 1024)))
+
+# Materiais das aulas: quantos baixam ao mesmo tempo e, para servidores com Accept-Ranges,
+# em quantas faixas paralelas um arquivo é dividido (cada faixa com pelo menos ATTACHMENT_SPLIT_SIZE bytes)
+ATTACHMENT_WORKERS = int(os.getenv("ATTACHMENT_WORKERS", "4"))
+ATTACHMENT_PARTS = int(os.getenv("ATTACHMENT_PARTS", "4"))
+ATTACHMENT_SPLIT_SIZE = int(os.getenv("ATTACHMENT_SPLIT_SIZE", str(8 * 1024 * 1024)))
+
 
 def clear_screen():
     os.system("cls" if os.name == "nt" else "clear")
@@ -29,37 +142,705 @@ def sanitize_string(string: str):
     return re.sub(r'[@#$%&*/:^{}<>?"]', "", string).strip()
 
 
+def lesson_resource(lesson: dict) -> str:
+    return (lesson.get("resource") or "").split("/")[-1]
+
+
+def lesson_base_path(save_path: Path, group_index: int, lesson_index: int, lesson: dict) -> Path:
+    # Caminho sem extensão de uma aula: "NN. Grupo/NN. Aula"
+    group_folder = save_path / f"{group_index:02d}. {sanitize_string(lesson.get('group_title', 'Sem Grupo'))}"
+    return group_folder / f"{lesson_index:02d}. {sanitize_string(lesson.get('title', 'Sem título'))}"
+
+
+def lesson_scope(target: Path) -> str:
+    # Formação dona do caminho ("Cursos/<formação>"): a mesma aula pode estar em várias
+    return str(Path(*target.parts[:2]))
+
+
+def lesson_target_path(base_path: Path, lesson: dict) -> Path:
+    # Arquivo que representa a aula no índice: o vídeo, ou o .txt se a aula não tiver vídeo
+    suffix = ".mp4" if lesson_resource(lesson) else ".txt"
+    return base_path.parent / f"{base_path.name}{suffix}"
+
+
+class MetadataCache:
+    # Guarda respostas da API em disco; dentro do TTL não faz requisição, depois disso
+    # revalida com ETag/Last-Modified e só baixa o corpo de novo se ele mudou
+    def __init__(self, session: requests.Session, folder: Path = METADATA_DIR, offline: bool = OFFLINE):
+        self.session = session
+        self.folder = folder
+        self.offline = offline
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, url: str, params: Optional[dict]) -> Path:
+        key = json.dumps([url, sorted((params or {}).items())])
+        return self.folder / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+    def _save(self, path: Path, entry: dict):
+        temp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        temp_path.write_text(json.dumps(entry), encoding="utf-8")
+        os.replace(temp_path, path)
+
+    def fetch(self, url: str, params: Optional[dict] = None, ttl: int = METADATA_TTL):
+        # Retorna (conteúdo, mudou), onde "mudou" indica que o corpo veio da rede
+        path = self._path(url, params)
+        entry = None
+        if path.exists():
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                entry = None
+
+        if entry and (self.offline or time.time() - entry["fetched_at"] < ttl):
+            return entry["body"], False
+        if self.offline:
+            raise RuntimeError(f"Modo offline: {url} não está no cache")
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        with TRACER.span("api", "api", host=urlparse(url).netloc, path=urlparse(url).path) as trace:
+            res = self.session.get(url, params=params, headers=headers)
+            trace["status"] = res.status_code
+        if res.status_code == 304 and entry:
+            entry["fetched_at"] = time.time()
+            self._save(path, entry)
+            return entry["body"], False
+        res.raise_for_status()
+
+        self._save(path, {
+            "url": url,
+            "params": params,
+            "fetched_at": time.time(),
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "body": res.text,
+        })
+        return res.text, True
+
+    def get_json(self, url: str, params: Optional[dict] = None, ttl: int = METADATA_TTL):
+        return json.loads(self.fetch(url, params, ttl)[0])
+
+
+class LessonIndex:
+    # Índice SQLite das aulas sincronizadas, por id da aula, resource do vídeo e formação.
+    # Permite decidir o que baixar sem construir downloaders nem consultar os provedores.
+    def __init__(self, path: Path = INDEX_PATH, store: Optional["VideoStore"] = None):
+        self._lock = threading.Lock()
+        # Store de vídeos, avisado quando uma aula renomeada leva o seu link para outro caminho
+        self.store = store
+        # Vários processos do modo batch usam o mesmo arquivo: espera o lock em vez de falhar
+        self.conn = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        # Reservas de vídeo dos processos em andamento no modo batch
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS claims (
+                resource TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                claimed_at TEXT
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS lessons (
+                lesson_id TEXT NOT NULL,
+                resource TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER,
+                duration REAL,
+                updated_at TEXT,
+                synced_at TEXT,
+                PRIMARY KEY (lesson_id, resource, scope)
+            )"""
+        )
+        self.conn.commit()
+        self.rows = {
+            (lesson_id, resource, scope): {"path": path, "size": size, "updated_at": updated_at}
+            for lesson_id, resource, scope, path, size, updated_at in self.conn.execute(
+                "SELECT lesson_id, resource, scope, path, size, updated_at FROM lessons"
+            )
+        }
+
+    @staticmethod
+    def key(lesson: dict):
+        resource = lesson_resource(lesson)
+        return str(lesson.get("id") or lesson.get("slug") or resource), resource
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        if os.name != "posix":
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def claim(self, lesson: dict) -> bool:
+        # Reserva o vídeo da aula para este processo, para que só um processo o baixe; outro
+        # processo vivo com o mesmo vídeo ganha a vez. Reservas de processos que morreram são
+        # assumidas. Aulas sem vídeo não disputam nada.
+        lesson_id, resource = self.key(lesson)
+        if not lesson_resource(lesson):
+            return True
+        pid = os.getpid()
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO claims VALUES (?, ?, ?)", (resource, pid, datetime.now().isoformat())
+            )
+            claimed = cursor.rowcount == 1
+            if not claimed:
+                owner = self.conn.execute("SELECT pid FROM claims WHERE resource = ?", (resource,)).fetchone()
+                if owner is None or owner[0] == pid:
+                    claimed = True
+                elif not self._alive(owner[0]):
+                    cursor = self.conn.execute(
+                        "UPDATE claims SET pid = ?, claimed_at = ? WHERE resource = ? AND pid = ?",
+                        (pid, datetime.now().isoformat(), resource, owner[0]),
+                    )
+                    claimed = cursor.rowcount == 1
+            self.conn.commit()
+            if claimed:
+                self._refresh(lesson_id, resource)
+            return claimed
+
+    def _refresh(self, lesson_id: str, resource: str):
+        # Outro processo pode ter terminado a aula depois que este índice foi carregado
+        for scope, path, size, updated_at in self.conn.execute(
+            "SELECT scope, path, size, updated_at FROM lessons WHERE lesson_id = ? AND resource = ?", (lesson_id, resource)
+        ).fetchall():
+            self.rows[(lesson_id, resource, scope)] = {"path": path, "size": size, "updated_at": updated_at}
+
+    def release(self, lesson: dict):
+        _, resource = self.key(lesson)
+        with self._lock:
+            self.conn.execute("DELETE FROM claims WHERE resource = ? AND pid = ?", (resource, os.getpid()))
+            self.conn.commit()
+
+    def release_all(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM claims WHERE pid = ?", (os.getpid(),))
+            self.conn.commit()
+
+    def plan(self, lesson: dict, target: Path, trust: bool = TRUST_INDEX) -> str:
+        # Retorna "new", "changed", "broken", "moved" ou "ok"; só as três primeiras precisam de download
+        row = self.rows.get(self.key(lesson) + (lesson_scope(target),))
+        if row is None:
+            return "new"
+        if row["updated_at"] != lesson.get("updated_at"):
+            if target.exists():
+                target.unlink()
+            return "changed"
+
+        indexed = Path(row["path"])
+        if indexed != target:
+            if indexed.exists() and indexed.stat().st_size == row["size"]:
+                # Aula renomeada: move os arquivos em vez de baixar de novo
+                target.parent.mkdir(parents=True, exist_ok=True)
+                old_base = indexed.parent / indexed.stem
+                new_base = target.parent / target.stem
+                for suffix in (".mp4", ".txt", "_arquivos"):
+                    old_path = old_base.parent / f"{old_base.name}{suffix}"
+                    if old_path.exists():
+                        os.replace(old_path, new_base.parent / f"{new_base.name}{suffix}")
+                if self.store is not None:
+                    self.store.move_ref(indexed, target)
+                self.record(lesson, target)
+                return "moved"
+            return "broken"
+
+        if trust:
+            return "ok"
+        if not target.exists() or target.stat().st_size != row["size"]:
+            if target.exists():
+                target.unlink()
+            return "broken"
+        return "ok"
+
+    def record(self, lesson: dict, target: Path, duration: Optional[float] = None):
+        lesson_id, resource = self.key(lesson)
+        scope = lesson_scope(target)
+        size = target.stat().st_size
+        updated_at = lesson.get("updated_at")
+        if duration is None:
+            duration = lesson.get("duration")
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO lessons VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (lesson_id, resource, scope, str(target), size, duration, updated_at, datetime.now().isoformat()),
+            )
+            self.conn.commit()
+            self.rows[(lesson_id, resource, scope)] = {"path": str(target), "size": size, "updated_at": updated_at}
+
+
+class CatalogIndex:
+    # Catálogo de formações/cursos no mesmo SQLite do índice de aulas, na ordem da API
+    def __init__(self, path: Path = INDEX_PATH):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS catalog (
+                slug TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                type TEXT,
+                updated_at TEXT,
+                position INTEGER,
+                synced_at REAL
+            )"""
+        )
+        self.conn.commit()
+
+    def synced_at(self) -> Optional[float]:
+        row = self.conn.execute("SELECT MIN(synced_at) FROM catalog").fetchone()
+        return row[0] if row else None
+
+    def replace(self, items: list):
+        now = time.time()
+        with self._lock:
+            self.conn.execute("DELETE FROM catalog")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO catalog VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (item["slug"], item["title"], item.get("type"),
+                     item.get("updated_at"), position, now)
+                    for position, item in enumerate(items)
+                ],
+            )
+            self.conn.commit()
+
+    def search(self, term: str = "") -> list:
+        # Trecho do título ou do slug, sem diferenciar maiúsculas (em Python: o lower() do
+        # SQLite ignora letras acentuadas)
+        term = term.strip().casefold()
+        rows = self.conn.execute("SELECT slug, title, type, updated_at FROM catalog ORDER BY position")
+        return [
+            {"slug": slug, "title": title, "type": kind, "updated_at": updated_at}
+            for slug, title, kind, updated_at in rows
+            if term in title.casefold() or term in slug.casefold()
+        ]
+
+
+class VideoStore:
+    # Vídeos guardados uma única vez em STORE_DIR/<provedor>/<video_id>.mp4 e ligados nos
+    # caminhos das aulas. As referências ficam no SQLite para que a limpeza só apague
+    # vídeos que nenhuma aula usa mais. Cada vídeo guarda o updated_at da aula que o baixou:
+    # uma aula alterada na API não reaproveita a versão antiga.
+    LINK_MODES = {"hardlink": ("hardlink", "symlink", "copy"), "symlink": ("symlink", "copy"), "copy": ("copy",)}
+
+    def __init__(self, path: Path = INDEX_PATH, folder: Path = STORE_DIR, link_mode: str = STORE_LINK):
+        self.folder = folder
+        self.link_modes = self.LINK_MODES.get(link_mode, self.LINK_MODES["hardlink"])
+        self._lock = threading.Lock()
+        # video_id -> Event de quem está baixando o vídeo neste processo
+        self._pending = {}
+        self.conn = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS store_videos (
+                provider TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER,
+                duration REAL,
+                updated_at TEXT,
+                stored_at TEXT,
+                PRIMARY KEY (provider, video_id)
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS store_refs (
+                target TEXT PRIMARY KEY,
+                provider TEXT NOT NULL,
+                video_id TEXT NOT NULL
+            )"""
+        )
+        self.conn.commit()
+
+    def find(self, video_id: str, updated_at: Optional[str]) -> Optional[dict]:
+        rows = self.conn.execute(
+            "SELECT provider, path, size, duration FROM store_videos WHERE video_id = ? AND updated_at IS ?",
+            (video_id, updated_at),
+        ).fetchall()
+        for provider, path, size, duration in rows:
+            stored = Path(path)
+            if stored.exists() and stored.stat().st_size == size:
+                return {"provider": provider, "video_id": video_id, "path": path, "size": size, "duration": duration}
+        return None
+
+    def reserve(self, video_id: str, updated_at: Optional[str]) -> Optional[dict]:
+        # Retorna o vídeo se ele já está no store nesta versão. Se outra aula deste processo está
+        # baixando o mesmo vídeo, espera por ela. None: quem chamou baixa o vídeo e depois chama done().
+        while True:
+            with self._lock:
+                entry = self.find(video_id, updated_at)
+                if entry is not None:
+                    return entry
+                event = self._pending.get(video_id)
+                if event is None:
+                    self._pending[video_id] = threading.Event()
+                    return None
+            event.wait()
+
+    def done(self, video_id: str):
+        with self._lock:
+            event = self._pending.pop(video_id, None)
+        if event is not None:
+            event.set()
+
+    def add(self, provider: str, video_id: str, source: Path, duration: Optional[float],
+            updated_at: Optional[str]) -> dict:
+        # Move o vídeo recém-baixado para o store (no lugar de uma versão antiga, se houver)
+        # e liga de volta no caminho da aula
+        stored = self.folder / provider / f"{sanitize_string(video_id)}{source.suffix}"
+        with self._lock:
+            entry = self.find(video_id, updated_at)
+            if entry is None:
+                stored.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(source), str(stored))
+                size = stored.stat().st_size
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO store_videos VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (provider, video_id, str(stored), size, duration, updated_at, datetime.now().isoformat()),
+                )
+                self.conn.commit()
+                entry = {"provider": provider, "video_id": video_id, "path": str(stored), "size": size,
+                         "duration": duration}
+        self.link(entry, source)
+        return entry
+
+    def link(self, entry: dict, target: Path):
+        stored = Path(entry["path"])
+        if target.exists() and os.path.samefile(target, stored):
+            # Já é um link para o vídeo (o rename sobre o mesmo inode não faria nada)
+            self._ref(entry, target)
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = target.with_name(f"{target.name}.link")
+        temp_path.unlink(missing_ok=True)
+        for mode in self.link_modes:
+            try:
+                if mode == "hardlink":
+                    os.link(stored, temp_path)
+                elif mode == "symlink":
+                    # Relativo, para continuar válido fora do container e se a pasta mudar de lugar
+                    os.symlink(os.path.relpath(stored.resolve(), target.parent.resolve()), temp_path)
+                else:
+                    shutil.copy2(stored, temp_path)
+                break
+            except OSError:
+                temp_path.unlink(missing_ok=True)
+        os.replace(temp_path, target)
+        temp_path.unlink(missing_ok=True)
+        self._ref(entry, target)
+
+    def _ref(self, entry: dict, target: Path):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO store_refs VALUES (?, ?, ?)", (str(target), entry["provider"], entry["video_id"])
+            )
+            self.conn.commit()
+
+    def move_ref(self, old_target: Path, new_target: Path):
+        # A aula mudou de caminho: a referência acompanha, e um symlink relativo é refeito
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT provider, video_id FROM store_refs WHERE target = ?", (str(old_target),)
+            ).fetchone()
+            if row is None:
+                return
+            self.conn.execute("DELETE FROM store_refs WHERE target = ?", (str(old_target),))
+            self.conn.commit()
+            entry = self.conn.execute(
+                "SELECT path FROM store_videos WHERE provider = ? AND video_id = ?", row
+            ).fetchone()
+        if entry is None:
+            return
+        stored = {"provider": row[0], "video_id": row[1], "path": entry[0]}
+        if new_target.is_symlink() and not new_target.exists():
+            new_target.unlink()
+        self.link(stored, new_target)
+
+    def prune(self):
+        # Esquece referências cujo arquivo sumiu ou foi substituído e apaga os vídeos que
+        # ficaram sem nenhuma. Retorna (vídeos removidos, bytes liberados).
+        with self._lock:
+            videos = {
+                (provider, video_id): Path(path)
+                for provider, video_id, path in self.conn.execute("SELECT provider, video_id, path FROM store_videos")
+            }
+            for target, provider, video_id in self.conn.execute("SELECT target, provider, video_id FROM store_refs").fetchall():
+                stored = videos.get((provider, video_id))
+                linked = Path(target)
+                alive = stored is not None and linked.exists() and stored.exists() and (
+                    os.path.samefile(linked, stored) or linked.stat().st_size == stored.stat().st_size
+                )
+                if not alive:
+                    self.conn.execute("DELETE FROM store_refs WHERE target = ?", (target,))
+            removed, freed = 0, 0
+            for provider, video_id, path in self.conn.execute(
+                "SELECT provider, video_id, path FROM store_videos WHERE NOT EXISTS ("
+                "SELECT 1 FROM store_refs WHERE store_refs.provider = store_videos.provider "
+                "AND store_refs.video_id = store_videos.video_id)"
+            ).fetchall():
+                stored = Path(path)
+                if stored.exists():
+                    freed += stored.stat().st_size
+                    stored.unlink()
+                self.conn.execute("DELETE FROM store_videos WHERE provider = ? AND video_id = ?", (provider, video_id))
+                removed += 1
+            self.conn.commit()
+        return removed, freed
+
+
+class LessonMetrics:
+    # Números de uma aula: bytes, tempo, segmentos, novas tentativas e provedor usado
+    def __init__(self, module_title: str, lesson_title: str):
+        self.module = module_title
+        self.lesson = lesson_title
+        self.provider = None
+        self.status = None
+        self.bytes = 0
+        self.attachment_bytes = 0
+        self.segments = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add_segment(self, size: int):
+        with self._lock:
+            self.segments += 1
+            self.bytes += size
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def add_attachment(self, size: int):
+        with self._lock:
+            self.attachment_bytes += size
+
+    def to_dict(self) -> dict:
+        seconds = (self.finished or time.monotonic()) - self.started
+        total_bytes = self.bytes + self.attachment_bytes
+        return {
+            "module": self.module,
+            "lesson": self.lesson,
+            "status": self.status,
+            "provider": self.provider,
+            "bytes": total_bytes,
+            "video_bytes": self.bytes,
+            "attachment_bytes": self.attachment_bytes,
+            "segments": self.segments,
+            "retries": self.retries,
+            "seconds": round(seconds, 3),
+            "mb_s": round(total_bytes / seconds / 1e6, 3) if seconds > 0 else 0.0,
+        }
+
+
+class RunMetrics:
+    # Métricas da execução inteira, por host e por aula, exportadas em JSON/CSV no
+    # relatório e, opcionalmente, em um textfile do Prometheus atualizado durante a execução.
+    # A latência fica em faixas fixas (histograma, como no Prometheus): memória constante e
+    # percentis estimados sem copiar nem ordenar nada com o lock na mão
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75,
+                       1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, textfile: str = METRICS_TEXTFILE):
+        self.textfile = Path(textfile) if textfile else None
+        # Rótulo "task" das séries no modo batch, onde cada tarefa grava o próprio textfile
+        self.label = None
+        self.hosts = {}
+        self.lessons = []
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._exporter = None
+
+    def record_request(self, url: str, elapsed: float, size: int, status: Optional[int], retried: bool = False):
+        host = urlparse(url).netloc or url
+        with self._lock:
+            stats = self.hosts.get(host)
+            if stats is None:
+                stats = self.hosts[host] = {"requests": 0, "bytes": 0, "errors": 0, "retries": 0,
+                                            "latencies": [0] * (len(self.LATENCY_BUCKETS) + 1)}
+            stats["requests"] += 1
+            stats["bytes"] += size
+            stats["latencies"][bisect.bisect_left(self.LATENCY_BUCKETS, elapsed)] += 1
+            if status is None or status >= 400:
+                stats["errors"] += 1
+            if retried:
+                stats["retries"] += 1
+
+    def start_lesson(self, module_title: str, lesson_title: str) -> LessonMetrics:
+        return LessonMetrics(module_title, lesson_title)
+
+    def finish_lesson(self, lesson: LessonMetrics, status: str):
+        lesson.status = status
+        lesson.finished = time.monotonic()
+        with self._lock:
+            self.lessons.append(lesson)
+
+    @classmethod
+    def _percentile(cls, counts: list, fraction: float) -> float:
+        # Interpola dentro da faixa, como o histogram_quantile do Prometheus; a última faixa
+        # (acima do maior limite) devolve o maior limite
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = fraction * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(cls.LATENCY_BUCKETS):
+                    return cls.LATENCY_BUCKETS[-1]
+                lower = cls.LATENCY_BUCKETS[index - 1] if index else 0.0
+                return lower + (cls.LATENCY_BUCKETS[index] - lower) * (rank - seen) / count
+            seen += count
+        return cls.LATENCY_BUCKETS[-1]
+
+    def host_summary(self) -> dict:
+        with self._lock:
+            hosts = {host: dict(stats, latencies=list(stats["latencies"])) for host, stats in self.hosts.items()}
+        seconds = max(time.monotonic() - self.started, 1e-6)
+        summary = {}
+        for host, stats in hosts.items():
+            latencies = stats.pop("latencies")
+            summary[host] = dict(
+                stats,
+                mb_s=round(stats["bytes"] / seconds / 1e6, 3),
+                latency_p50_ms=round(self._percentile(latencies, 0.5) * 1000, 1),
+                latency_p90_ms=round(self._percentile(latencies, 0.9) * 1000, 1),
+                latency_p99_ms=round(self._percentile(latencies, 0.99) * 1000, 1),
+            )
+        return summary
+
+    def write_reports(self, base_path: Path) -> list:
+        with self._lock:
+            lessons = [lesson.to_dict() for lesson in self.lessons]
+        json_path = base_path.with_suffix(".json")
+        json_path.write_text(json.dumps({
+            "seconds": round(time.monotonic() - self.started, 3),
+            "lessons": lessons,
+            "hosts": self.host_summary(),
+            "concurrency": CONCURRENCY.snapshot(),
+        }, indent=2, ensure_ascii=False), encoding="utf-8")
+
+        csv_path = base_path.with_suffix(".csv")
+        fields = ["module", "lesson", "status", "provider", "bytes", "video_bytes", "attachment_bytes",
+                  "segments", "retries", "seconds", "mb_s"]
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(lessons)
+        return [json_path, csv_path]
+
+    def write_prometheus(self):
+        if not self.textfile:
+            return
+        with self._lock:
+            statuses = collections.Counter(lesson.status for lesson in self.lessons)
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: list):
+            lines.append(f"# HELP rocketseat_{name} {help_text}")
+            lines.append(f"# TYPE rocketseat_{name} {kind}")
+            for labels, value in samples:
+                if self.label:
+                    labels = dict(labels, task=self.label)
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"rocketseat_{name}{{{label_text}}} {value}")
+
+        hosts = self.host_summary()
+        metric("bytes_total", "counter", "Bytes baixados por host.",
+               [({"host": host}, stats["bytes"]) for host, stats in hosts.items()])
+        metric("requests_total", "counter", "Requisições por host.",
+               [({"host": host}, stats["requests"]) for host, stats in hosts.items()])
+        metric("errors_total", "counter", "Requisições com erro por host.",
+               [({"host": host}, stats["errors"]) for host, stats in hosts.items()])
+        metric("retries_total", "counter", "Novas tentativas de segmentos por host.",
+               [({"host": host}, stats["retries"]) for host, stats in hosts.items()])
+        metric("throughput_bytes_per_second", "gauge", "Vazão média por host desde o início da execução.",
+               [({"host": host}, stats["mb_s"] * 1e6) for host, stats in hosts.items()])
+        metric("segment_latency_seconds", "gauge", "Percentis da latência dos segmentos por host.",
+               [({"host": host, "quantile": quantile}, stats[f"latency_p{name}_ms"] / 1000)
+                for host, stats in hosts.items() for quantile, name in (("0.5", "50"), ("0.9", "90"), ("0.99", "99"))])
+        metric("concurrency_limit", "gauge", "Limite atual do controlador de concorrência por host.",
+               [({"host": host}, state["limit"]) for host, state in CONCURRENCY.snapshot().items()])
+        metric("lessons_total", "counter", "Aulas finalizadas por resultado.",
+               [({"status": status}, count) for status, count in statuses.items()])
+
+        # Escrita atômica, como o coletor de textfile do node_exporter espera
+        self.textfile.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.textfile.with_suffix(f".{os.getpid()}.tmp")
+        temp_path.write_text("\n".join(lines) + "\n")
+        os.replace(temp_path, self.textfile)
+
+    def start_exporter(self, interval: float = METRICS_INTERVAL):
+        if not self.textfile or self._exporter is not None:
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval):
+                self.write_prometheus()
+
+        self._exporter = threading.Thread(target=loop, daemon=True)
+        self._exporter.start()
+
+    def stop_exporter(self):
+        if self._exporter is not None:
+            self._stop.set()
+            self._exporter.join()
+            self._exporter = None
+        self.write_prometheus()
+
+
 class DownloadReport:
-    def __init__(self):
+    def __init__(self, label: Optional[str] = None):
+        # Rótulo opcional no nome do arquivo, para relatórios de processos em paralelo
+        self.label = label
         self.successful_downloads = []
         self.failed_downloads = []
+        self.skipped_downloads = 0
         self.start_time = None
         self.end_time = None
+        self._lock = threading.Lock()
     
     def start(self):
         self.start_time = datetime.now()
+        METRICS.start_exporter()
         print(f"Início do download: {self.start_time.strftime('%d/%m/%Y %H:%M:%S')}")
     
     def add_success(self, module_title, lesson_title):
-        self.successful_downloads.append({
-            'module': module_title,
-            'lesson': lesson_title,
-            'timestamp': datetime.now()
-        })
-        print(f"✓ Aula baixada com sucesso: {module_title} - {lesson_title}")
+        with self._lock:
+            self.successful_downloads.append({
+                'module': module_title,
+                'lesson': lesson_title,
+                'timestamp': datetime.now()
+            })
+            print(f"✓ Aula baixada com sucesso: {module_title} - {lesson_title}")
     
+    def add_skipped(self, count: int):
+        with self._lock:
+            self.skipped_downloads += count
+
     def add_failure(self, module_title, lesson_title, error):
-        self.failed_downloads.append({
-            'module': module_title,
-            'lesson': lesson_title,
-            'error': str(error),
-            'timestamp': datetime.now()
-        })
-        print(f"✗ Erro ao baixar aula: {module_title} - {lesson_title}")
-        print(f"   Erro: {str(error)}")
+        with self._lock:
+            self.failed_downloads.append({
+                'module': module_title,
+                'lesson': lesson_title,
+                'error': str(error),
+                'timestamp': datetime.now()
+            })
+            print(f"✗ Erro ao baixar aula: {module_title} - {lesson_title}")
+            print(f"   Erro: {str(error)}")
     
     def finish(self):
         self.end_time = datetime.now()
+        METRICS.stop_exporter()
         self.generate_report()
     
     def generate_report(self):
@@ -76,6 +857,7 @@ class DownloadReport:
             f"Total de aulas: {total_attempts}",
             f"Aulas baixadas com sucesso: {len(self.successful_downloads)}",
             f"Aulas com erro: {len(self.failed_downloads)}",
+            f"Aulas já sincronizadas (puladas): {self.skipped_downloads}",
             "\n=== AULAS BAIXADAS COM SUCESSO ==="
         ]
         
@@ -92,123 +874,1199 @@ class DownloadReport:
                 report.append(f"  Erro: {download['error']}")
                 report.append(f"  Horário: {download['timestamp'].strftime('%H:%M:%S')}")
         
+        concurrency = CONCURRENCY.snapshot()
+        if concurrency:
+            report.append("\n=== CONCORRÊNCIA POR HOST ===")
+            for host, state in concurrency.items():
+                report.append(f"- {host}: limite final {state['limit']}, {state['throughput_mb_s']} MB/s, "
+                              f"latência {state['latency_ms']} ms, {state['throttled']} respostas de throttling")
+
         report_text = "\n".join(report)
         
         # Salvar relatório em arquivo
-        report_path = Path("relatorios") / f"relatorio_{self.end_time.strftime('%Y%m%d_%H%M%S')}.txt"
+        suffix = f"_{sanitize_string(self.label)}" if self.label else ""
+        report_path = Path("relatorios") / f"relatorio_{self.end_time.strftime('%Y%m%d_%H%M%S')}{suffix}.txt"
         report_path.parent.mkdir(exist_ok=True)
         with open(report_path, "w", encoding="utf-8") as f:
             f.write(report_text)
         
+        # Versões para máquina (JSON e CSV) com as métricas por aula e por host
+        metric_paths = METRICS.write_reports(report_path)
+        
         # Imprimir relatório no console
         print("\n" + "="*50)
         print(report_text)
         print("="*50)
         print(f"\nRelatório salvo em: {report_path}")
+        print(f"Métricas salvas em: {', '.join(str(path) for path in metric_paths)}")
 
 
-class PandaVideo:
-    def __init__(self, video_id: str, save_path: str, threads_count=10):
-        self.video_id = video_id
-        self.domain = "b-vz-762f4670-e04.tv.pandavideo.com.br"
-        self.session = requests.session()
-        self.session.headers.update({
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
-            "Accept": "*/*",
-            "Accept-Language": "en-US,en;q=0.9",
-            "Origin": "https://app.rocketseat.com.br",
-            "Referer": "https://app.rocketseat.com.br/",
-        })
-        self.save_path = save_path
-        self.threads_count = threads_count
+class HTTPPool:
+    # Uma sessão por host, compartilhada por todas as aulas do processo, para reaproveitar
+    # conexões keep-alive. Os headers de cada provedor vão por requisição, não na sessão.
+    def __init__(self):
+        self._sessions = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def session_for(self, url: str, threads_count: int = SEGMENT_THREADS_MAX,
+                    workers: int = LESSON_WORKERS) -> requests.Session:
+        host = urlparse(url).netloc or url
+        # Todos os workers simultâneos (aulas ou materiais) podem usar o mesmo host, limitado pelo teto global
+        pool_size = max(1, min(threads_count * workers, MAX_CONNECTIONS))
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                self._sessions[host] = session
+            if pool_size > self._sizes.get(host, 0):
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sizes[host] = pool_size
+            return session
+
+
+HTTP_POOL = HTTPPool()
+
+
+def parse_rate(value: str) -> int:
+    value = value.strip().upper().removesuffix("B")
+    multiplier = {"K": 1000, "M": 1000 ** 2, "G": 1000 ** 3}.get(value[-1:], 1)
+    if multiplier != 1:
+        value = value[:-1]
+    return int(float(value or 0) * multiplier)
+
+
+class BandwidthLimiter:
+    # Token bucket único para o processo: segmentos e materiais tiram bytes do mesmo balde,
+    # com capacidade de 1 segundo de banda para absorver rajadas curtas
+    def __init__(self, rate: str = BANDWIDTH_LIMIT, schedule: str = BANDWIDTH_SCHEDULE):
+        self.default_rate = parse_rate(rate)
+        self.schedule = []
+        for entry in filter(None, (item.strip() for item in schedule.split(","))):
+            window, window_rate = entry.split("=")
+            start, end = (self._minutes(moment) for moment in window.split("-"))
+            self.schedule.append((start, end, parse_rate(window_rate)))
+        # No modo batch cada processo fica com 1/share da banda configurada
+        self.share = 1
+        self._lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    @staticmethod
+    def _minutes(moment: str) -> int:
+        hours, minutes = moment.strip().split(":")
+        return int(hours) * 60 + int(minutes)
+
+    def current_rate(self) -> int:
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            # Faixas como 22:00-06:00 atravessam a meia-noite
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate // self.share
+        return self.default_rate // self.share
+
+    def reserve(self, amount: int) -> float:
+        # Retira `amount` bytes do balde e retorna quantos segundos esperar antes de seguir
+        rate = self.current_rate()
+        if rate <= 0 or amount <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(float(rate), self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / rate)
+
+    def consume(self, amount: int):
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+
+BANDWIDTH = BandwidthLimiter()
+
+
+class ConcurrencyController:
+    # Controle AIMD de requisições simultâneas para um host: soma 1 enquanto a vazão
+    # continua subindo e corta pela metade num 429 ou quando uma fração relevante da janela
+    # (THROTTLE_RATIO) volta com throttling (403/503), ou em 3/4 quando a latência média
+    # dispara em relação à melhor já vista. Um 503 isolado não derruba o limite
+    THROTTLE_STATUS = (403, 429, 503)
+    THROTTLE_RATIO = 0.1
+
+    def __init__(self, host: str, initial: int = SEGMENT_THREADS, maximum: int = SEGMENT_THREADS_MAX,
+                 minimum: int = 1, window: int = 20):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = min(max(initial, minimum), self.maximum)
+        self.window = window
+        self.active = 0
+        self.condition = threading.Condition()
+        self.best_latency = None
+        self.last_throughput = 0.0
+        self.throughput = 0.0
+        self.latency = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.stalled_windows = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_latencies = []
+        self.window_requests = 0
+        self.window_throttled = 0
+        self.window_cut = False
+
+    def acquire(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    def release(self, elapsed: float, size: int, status: Optional[int]):
+        changed = False
+        with self.condition:
+            self.active -= 1
+            self.requests += 1
+            self.window_requests += 1
+            if status is None or status >= 400:
+                self.errors += 1
+            if status in self.THROTTLE_STATUS:
+                self.throttled += 1
+                self.window_throttled += 1
+                # 429 é o servidor pedindo para ir mais devagar: corta na hora, uma vez por
+                # janela, para uma rajada de 429 não derrubar o limite ao mínimo
+                if status == 429 and not self.window_cut:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self.window_cut = True
+                    changed = True
+            else:
+                self.window_bytes += size
+                self.window_latencies.append(elapsed)
+
+            if self.window_requests >= self.window:
+                changed = self._adjust() or changed
+            self.condition.notify_all()
+        if changed:
+            print(f"\n[concorrência] {self.host}: {self.limit} requisições simultâneas")
+            CONCURRENCY.save()
+
+    def _adjust(self) -> bool:
+        previous = self.limit
+        elapsed = max(time.monotonic() - self.window_start, 1e-6)
+        self.throughput = self.window_bytes / elapsed
+        if self.window_latencies:
+            self.latency = sum(self.window_latencies) / len(self.window_latencies)
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+
+        if self.window_cut:
+            pass
+        elif self.window_throttled >= self.THROTTLE_RATIO * self.window_requests:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif self.latency > self.best_latency * 3:
+            self.limit = max(self.minimum, self.limit * 3 // 4)
+        elif self.throughput > self.last_throughput * 1.05:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.stalled_windows = 0
+        else:
+            # Vazão estável: sonda de novo de tempos em tempos
+            self.stalled_windows += 1
+            if self.stalled_windows >= 5:
+                self.limit = min(self.maximum, self.limit + 1)
+                self.stalled_windows = 0
+
+        self.last_throughput = self.throughput
+        self._reset_window()
+        return self.limit != previous
+
+    def snapshot(self) -> dict:
+        with self.condition:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "throughput_mb_s": round(self.throughput / 1e6, 3),
+                "latency_ms": round(self.latency * 1000, 1),
+                "best_latency_ms": round((self.best_latency or 0) * 1000, 1),
+                "requests": self.requests,
+                "errors": self.errors,
+                "throttled": self.throttled,
+            }
+
+
+class ConcurrencyRegistry:
+    # Um controlador por host, compartilhado por todas as aulas do processo
+    def __init__(self, state_path: Path = CONCURRENCY_STATE_PATH):
+        self.state_path = state_path
+        self._controllers = {}
+        self._lock = threading.Lock()
+
+    def for_host(self, url: str) -> ConcurrencyController:
+        host = urlparse(url).netloc or url
+        with self._lock:
+            if host not in self._controllers:
+                self._controllers[host] = ConcurrencyController(host)
+            return self._controllers[host]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            controllers = list(self._controllers.values())
+        return {controller.host: controller.snapshot() for controller in controllers}
+
+    def save(self):
+        # Estado atual em JSON para acompanhar em que limite cada host se estabilizou
+        temp_path = self.state_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        temp_path.write_text(json.dumps(self.snapshot(), indent=2))
+        os.replace(temp_path, self.state_path)
+
+
+CONCURRENCY = ConcurrencyRegistry()
+METRICS = RunMetrics()
+
+
+class Tracer:
+    # Spans completos ("X") por thread. Os segmentos do motor asyncio se sobrepõem na mesma
+    # thread, então viram eventos assíncronos ("b"/"e") para não embaralhar a linha do tempo.
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+        self.events = []
+        self.origin = time.perf_counter()
+        self._threads = set()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        atexit.register(self.save)
+
+    def add(self, name: str, category: str, started: float, finished: float, args: dict, overlapping: bool = False):
+        if not self.path:
+            return
+        thread = threading.current_thread()
+        event = {"name": name, "cat": category, "pid": os.getpid(), "tid": thread.ident,
+                 "ts": round((started - self.origin) * 1e6, 1), "args": args}
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self.events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread.ident,
+                                    "args": {"name": thread.name}})
+            if overlapping:
+                self._next_id += 1
+                self.events.append(dict(event, ph="b", id=self._next_id))
+                self.events.append(dict(event, ph="e", id=self._next_id, ts=round((finished - self.origin) * 1e6, 1), args={}))
+            else:
+                self.events.append(dict(event, ph="X", dur=round((finished - started) * 1e6, 1)))
 
-    def _create_temp_folder(self):
-        foldername = "".join(random.choices("ABCDEFGHIJKLMNOPQRSTUVWXYZ", k=5))
-        self.temp_folder = Path(".temp") / foldername
-        if not os.path.exists(self.temp_folder):
-            os.makedirs(self.temp_folder)
-        return self.temp_folder
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, overlapping: bool = False, **args):
+        # Devolve os argumentos do span, que podem ser completados dentro do bloco
+        started = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            self.add(name, category, started, time.perf_counter(), args, overlapping)
 
-    def __convert_segments(self):
-        ffmpeg_cmd = f'ffmpeg -hide_banner -loglevel error -stats -y -i "{self.temp_folder}/playlist.m3u8" -c copy -bsf:a aac_adtstoasc "{self.save_path}"'
-        os.system(ffmpeg_cmd)
-        for filename in os.listdir(self.temp_folder):
-            os.remove(self.temp_folder / filename)
-        os.removedirs(self.temp_folder)
+    def save(self):
+        with self._lock:
+            if not self.path or not self.events:
+                return
+            events, self.events, self._threads = self.events, [], set()
+        path = Path(self.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+        print(f"Trace salvo em {path}")
 
-    def __download_playlist(self, playlist_url: str):
-        print("Iniciando o download dos segmentos...")
-        self._create_temp_folder()
-        playlist_content = self.session.get(playlist_url).text
-        with open(self.temp_folder / "playlist.m3u8", "w") as file:
-            for line in playlist_content.splitlines():
-                line = line.split("/")[-1] if line.startswith("https") else line
-                file.write(f"{line}\n")
-        playlist = m3u8.loads(playlist_content)
 
-        threads = []
-        segment_queue = queue.Queue()
-        self.downloaded_segments = 0
-        self.total_segments = len(playlist.segments)
-        for segment in playlist.segments:
-            segment_queue.put(segment)
+TRACER = Tracer()
 
-        def worker():
-            while not segment_queue.empty():
-                segment = segment_queue.get()
-                filename = segment.uri.split("/")[-1]
-                with open(self.temp_folder / filename, "wb") as file:
-                    file.write(self.session.get(segment.uri).content)
-                segment_queue.task_done()
-                self.downloaded_segments += 1
-                print(
-                    f"\rBaixando segmento {self.downloaded_segments} de {self.total_segments}... ",
-                    end="",
-                    flush=True,
-                )
 
-        for _ in range(self.threads_count):
-            thread = threading.Thread(target=worker)
-            thread.start()
-            threads.append(thread)
+def progress(message: str):
+    # Linha de progresso que se sobrescreve; com QUIET=1 não aparece
+    if not QUIET:
+        print(f"\r{message}", end="", flush=True)
 
+
+def retry_delay(attempt: int, headers=None) -> float:
+    # Respeita Retry-After (segundos ou data HTTP); sem ele, backoff exponencial com jitter
+    retry_after = (headers or {}).get("Retry-After")
+    if retry_after:
+        try:
+            return min(RETRY_BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                wait = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                return min(RETRY_BACKOFF_MAX, max(0.0, wait))
+            except (TypeError, ValueError):
+                pass
+    ceiling = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def write_chunks(response: requests.Response, path, on_chunk=None) -> int:
+    # Grava o corpo em blocos de CHUNK_SIZE em "<path>.part" e só renomeia no fim,
+    # para que um arquivo pela metade nunca pareça completo
+    part_path = f"{path}.part"
+    size = 0
+    try:
+        with open(part_path, "wb") as file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                file.write(chunk)
+                size += len(chunk)
+                if on_chunk is not None:
+                    on_chunk(len(chunk))
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        response.close()
+    os.replace(part_path, path)
+    return size
+
+
+def controlled_fetch(get, url: str, retries: int = SEGMENT_RETRIES, metrics: Optional[LessonMetrics] = None,
+                     path=None):
+    with TRACER.span("segment", "segment", host=urlparse(url).netloc,
+                     lesson=metrics.lesson if metrics is not None else None) as trace:
+        result = _controlled_fetch(get, url, retries, metrics, path)
+        trace["bytes"] = result if path is not None else len(result)
+        return result
+
+
+def _controlled_fetch(get, url: str, retries: int, metrics: Optional[LessonMetrics], path):
+    # Baixa um segmento respeitando o limite do host e alimentando o controlador.
+    # Falhas transitórias custam uma nova tentativa do segmento, não o vídeo inteiro.
+    # Sem `path` devolve os bytes; com `path` grava em blocos direto no disco e devolve o tamanho.
+    controller = CONCURRENCY.for_host(url)
+    for attempt in range(retries + 1):
+        controller.acquire()
+        started = time.monotonic()
+        status = None
+        result = None
+        size = 0
+        response = None
+        try:
+            if path is None:
+                response = get(url)
+                status = response.status_code
+                response.raise_for_status()
+                result = response.content
+                size = len(result)
+            else:
+                # Com stream=True a vaga de conexão fica presa até o corpo ser lido
+                with CONNECTION_SLOTS:
+                    response = get(url, stream=True)
+                    status = response.status_code
+                    response.raise_for_status()
+                    size = write_chunks(response, path)
+                result = size
+        except requests.RequestException as e:
+            if response is not None:
+                response.close()
+            if attempt == retries or (status is not None and status not in RETRY_STATUS):
+                raise
+            error = e
+        finally:
+            elapsed = time.monotonic() - started
+            controller.release(elapsed, size, status)
+            METRICS.record_request(url, elapsed, size, status, retried=attempt > 0)
+        if result is not None:
+            if metrics is not None:
+                metrics.add_segment(size)
+            # A espera do limitador de banda acontece fora da vaga do controlador
+            BANDWIDTH.consume(size)
+            return result
+        if metrics is not None:
+            metrics.add_retry()
+        delay = retry_delay(attempt, response.headers if response is not None else None)
+        print(f"\nFalha em {url.split('/')[-1]} ({error}); tentativa {attempt + 2} de {retries + 1} em {delay:.1f}s")
+        time.sleep(delay)
+
+
+class AttachmentDownloader:
+    # Baixa um material em faixas de bytes paralelas quando o servidor aceita Range. O progresso
+    # de cada faixa fica em "<arquivo>.part.json", ao lado dos dados em "<arquivo>.part", e uma
+    # execução interrompida continua de onde parou.
+    SAVE_EVERY = 4 * 1024 * 1024
+
+    def __init__(self, parts: int = ATTACHMENT_PARTS, split_size: int = ATTACHMENT_SPLIT_SIZE,
+                 retries: int = SEGMENT_RETRIES):
+        self.parts = max(1, parts)
+        self.split_size = max(CHUNK_SIZE, split_size)
+        self.retries = retries
+
+    def _session(self, url: str) -> requests.Session:
+        # Até ATTACHMENT_WORKERS materiais ao mesmo tempo, cada um com `parts` faixas
+        return HTTP_POOL.session_for(url, self.parts, ATTACHMENT_WORKERS)
+
+    def _probe(self, url: str):
+        # Tamanho e suporte a Range; (None, False) se o HEAD não responder direito
+        try:
+            with CONNECTION_SLOTS:
+                response = self._session(url).head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException:
+            return None, False
+        if not response.ok:
+            return None, False
+        length = response.headers.get("Content-Length", "")
+        size = int(length) if length.isdigit() else None
+        return size, response.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+    def _plain(self, url: str, path: Path, on_chunk) -> int:
+        with CONNECTION_SLOTS:
+            response = self._session(url).get(url, stream=True, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            return write_chunks(response, path, on_chunk=on_chunk)
+
+    def _fetch_range(self, url: str, part_path: Path, current: list, lock: threading.Lock, save, on_chunk):
+        # current = [início, fim, bytes já gravados], atualizado conforme os blocos chegam
+        start, end = current[0], current[1]
+        for attempt in range(self.retries + 1):
+            offset = start + current[2]
+            if offset > end:
+                return
+            response = None
+            try:
+                with CONNECTION_SLOTS:
+                    response = self._session(url).get(
+                        url, headers={"Range": f"bytes={offset}-{end}"}, stream=True, timeout=REQUEST_TIMEOUT)
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise RuntimeError("o servidor ignorou o cabeçalho Range")
+                    unsaved = 0
+                    with open(part_path, "r+b") as file:
+                        file.seek(offset)
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            chunk = chunk[:end + 1 - start - current[2]]
+                            file.write(chunk)
+                            unsaved += len(chunk)
+                            with lock:
+                                current[2] += len(chunk)
+                            if on_chunk is not None:
+                                on_chunk(len(chunk))
+                            if unsaved >= self.SAVE_EVERY:
+                                # Só registra o progresso depois que os dados saíram do buffer
+                                file.flush()
+                                save()
+                                unsaved = 0
+                if start + current[2] <= end:
+                    raise requests.ConnectionError(f"faixa {start}-{end} veio incompleta")
+                return
+            except requests.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                if attempt == self.retries or (status is not None and status not in RETRY_STATUS):
+                    raise
+                time.sleep(retry_delay(attempt, e.response.headers if e.response is not None else None))
+            finally:
+                if response is not None:
+                    response.close()
+
+    def download(self, url: str, path: Path, on_chunk=None) -> int:
+        # Retorna quantos bytes foram baixados nesta execução (0 se o arquivo já estava completo)
+        size, ranged = self._probe(url)
+        if size is not None and path.exists() and path.stat().st_size == size:
+            return 0
+        if not ranged or not size:
+            return self._plain(url, path, on_chunk)
+
+        part_path = Path(f"{path}.part")
+        state_path = Path(f"{path}.part.json")
+        state = None
+        if part_path.exists() and state_path.exists():
+            try:
+                state = json.loads(state_path.read_text())
+                if state.get("size") != size:
+                    state = None
+            except (OSError, ValueError):
+                state = None
+        if state is None:
+            count = max(1, min(self.parts, -(-size // self.split_size)))
+            step = -(-size // count)
+            state = {"size": size, "ranges": [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]}
+            with open(part_path, "wb") as file:
+                file.truncate(size)
+
+        resumed = sum(current[2] for current in state["ranges"])
+        if resumed:
+            print(f"\t\tRetomando material: {resumed} de {size} bytes já baixados")
+        lock = threading.Lock()
+
+        def save():
+            with lock:
+                state_path.write_text(json.dumps(state))
+
+        pending = [current for current in state["ranges"] if current[0] + current[2] <= current[1]]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+                futures = [
+                    pool.submit(self._fetch_range, url, part_path, current, lock, save, on_chunk)
+                    for current in pending
+                ]
+                for future in as_completed(futures):
+                    future.result()
+        except RuntimeError:
+            # Accept-Ranges prometido mas não cumprido: baixa de uma vez só
+            part_path.unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            return self._plain(url, path, on_chunk)
+        finally:
+            if part_path.exists():
+                save()
+
+        os.replace(part_path, path)
+        state_path.unlink(missing_ok=True)
+        return size - resumed
+
+
+# Vídeos com menos que isso (em segundos) são considerados indisponíveis no provedor
+MIN_VIDEO_DURATION = 10
+# Diferença aceita entre a soma dos EXTINF e a duração da aula na API (fração, mínimo de 2s).
+# Com DEEP_VERIFY=1 o ffprobe também mede o arquivo final.
+DURATION_TOLERANCE = float(os.getenv("DURATION_TOLERANCE", "0.1"))
+DEEP_VERIFY = os.getenv("DEEP_VERIFY", "0") == "1"
+# Bytes recebidos × tamanho estimado pela banda da variante: com 0 (padrão) uma diferença acima
+# de DURATION_TOLERANCE só gera um aviso; acima de 0 é a tolerância que reprova o download
+BYTES_TOLERANCE = float(os.getenv("BYTES_TOLERANCE", "0"))
+# Qualidade escolhida nas duas fontes: "max", "min" ou uma altura alvo (ex.: "720" fica com a
+# melhor variante que não passa dela)
+VIDEO_QUALITY = os.getenv("VIDEO_QUALITY", "max").strip().lower().rstrip("p")
+# Orçamento por aula em MB (0 = sem limite): fica com a variante preferida cujo tamanho
+# estimado (banda × soma dos EXTINF) cabe nele, ou com a menor se nenhuma couber
+VIDEO_BUDGET_MB = float(os.getenv("VIDEO_BUDGET_MB", "0"))
+# JSON opcional com fontes HLS extras ou substitutas, no formato de HLS_PROVIDERS:
+# {"nome": {"domain": "...", "headers": {...}, "quality": "720"}}
+HLS_PROVIDERS_FILE = os.getenv("HLS_PROVIDERS_FILE", "")
+
+
+def variant_bandwidth(playlist) -> int:
+    info = playlist.stream_info
+    return info.average_bandwidth or info.bandwidth or 0
+
+
+def variant_height(playlist) -> int:
+    resolution = playlist.stream_info.resolution
+    return resolution[1] if resolution else 0
+
+
+def variant_label(playlist) -> str:
+    resolution = playlist.stream_info.resolution
+    return f"{resolution[0]}x{resolution[1]}" if resolution else f"{variant_bandwidth(playlist) // 1000}k"
+
+
+def rank_variants(playlists: list, quality: str = VIDEO_QUALITY) -> list:
+    # Ordena as variantes da preferida para a menos preferida pela banda declarada
+    ranked = sorted(playlists, key=lambda p: (variant_bandwidth(p), variant_height(p)), reverse=True)
+    if quality == "min":
+        return ranked[::-1]
+    if quality.isdigit():
+        # Acima do alvo só como último recurso, da menor para a maior
+        fitting = [p for p in ranked if variant_height(p) <= int(quality)]
+        return fitting + [p for p in ranked[::-1] if p not in fitting]
+    return ranked
+
+
+def absolute_playlist(content: str, url: str, resolve=urljoin) -> str:
+    # Resolve as URIs dos segmentos a partir da URL da própria playlist
+    lines = [resolve(url, line) if line and not line.startswith("#") else line for line in content.splitlines()]
+    return "\n".join(lines) + "\n"
+
+
+def load_variant(get, master_url: str, quality: str = VIDEO_QUALITY, resolve=urljoin):
+    # Baixa a playlist master, escolhe a variante por `quality` e VIDEO_BUDGET_MB e retorna
+    # (playlist de mídia com URIs absolutas, nome da variante, stream_info da variante ou None)
+    response = get(master_url)
+    response.raise_for_status()
+    master = m3u8.loads(response.text)
+    if not master.playlists:
+        return absolute_playlist(response.text, master_url, resolve), "direct", None
+
+    media = {}
+
+    def media_for(playlist) -> str:
+        if playlist.uri not in media:
+            url = resolve(master_url, playlist.uri)
+            response = get(url)
+            response.raise_for_status()
+            media[playlist.uri] = absolute_playlist(response.text, url, resolve)
+        return media[playlist.uri]
+
+    ranked = rank_variants(master.playlists, quality)
+    chosen = ranked[0]
+    # As variantes têm a mesma duração: a playlist da preferida basta para estimar todas
+    duration = sum(segment.duration or 0 for segment in m3u8.loads(media_for(chosen)).segments)
+
+    def estimate(playlist) -> float:
+        return variant_bandwidth(playlist) / 8 * duration
+
+    if VIDEO_BUDGET_MB > 0:
+        fitting = [p for p in ranked if estimate(p) <= VIDEO_BUDGET_MB * 1e6]
+        chosen = fitting[0] if fitting else min(ranked, key=variant_bandwidth)
+    print(
+        f"\tVariante {variant_label(chosen)}: {variant_bandwidth(chosen) / 1e6:.1f} Mbps, "
+        f"~{estimate(chosen) / 1e6:.0f} MB estimados"
+    )
+    return media_for(chosen), variant_label(chosen), chosen.stream_info
+
+
+def probe_playlist(provider: str, load_variant) -> dict:
+    # Valida a playlist de mídia sem baixar segmentos: precisa ter segmentos e
+    # uma soma de EXTINF plausível
+    try:
+        with TRACER.span("playlist", "playlist", provider=provider):
+            content, variant, stream_info = load_variant()
+            playlist = m3u8.loads(content)
+    except Exception as e:
+        return {"provider": provider, "ok": False, "error": str(e)}
+    duration = sum(segment.duration or 0 for segment in playlist.segments)
+    return {
+        "provider": provider,
+        "ok": bool(playlist.segments) and duration > MIN_VIDEO_DURATION,
+        "content": content,
+        "variant": variant,
+        "segments": len(playlist.segments),
+        "duration": duration,
+        # Banda anunciada na master: com AVERAGE-BANDWIDTH dá para estimar o tamanho do vídeo
+        "average_bandwidth": stream_info.average_bandwidth if stream_info is not None else None,
+        "bandwidth": stream_info.bandwidth if stream_info is not None else None,
+    }
+
+
+def is_streamable(playlist) -> bool:
+    # Segmentos criptografados ou fMP4 (EXT-X-MAP) precisam da playlist completa no ffmpeg
+    if any(key is not None and key.method not in (None, "NONE") for key in playlist.keys):
+        return False
+    return not playlist.segment_map
+
+
+def staging_folder(provider: str, video_id: str, variant: str) -> Path:
+    # Pasta fixa por provedor, vídeo e variante, para que uma nova execução encontre o que já
+    # foi baixado; cada provedor tem os próprios nomes de segmento e manifesto
+    variant = re.sub(r'[^0-9A-Za-z]+', '_', variant).strip('_')
+    return STAGING_DIR / f"{sanitize_string(provider)}_{sanitize_string(video_id)}_{variant}"
+
+
+def remux_playlist(playlist_path: Path, save_path: str) -> bool:
+    # Junta os segmentos de uma playlist local em um .mp4 sem recodificar. Escreve em .part e
+    # só renomeia no fim, como o SegmentStreamer: uma execução morta não deixa .mp4 truncado
+    part_path = f"{save_path}.part"
+    try:
+        with TRACER.span("ffmpeg remux", "process", file=save_path):
+            result = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", str(playlist_path),
+                 "-c", "copy", "-bsf:a", "aac_adtstoasc", "-f", "mp4", part_path],
+            )
+    except OSError as e:
+        print(f"Não foi possível iniciar o ffmpeg: {e}")
+        result = None
+    if result is None or result.returncode != 0:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+    os.replace(part_path, save_path)
+    return True
+
+
+def probe_duration(path: str) -> Optional[float]:
+    # Duração do arquivo segundo o ffprobe; 0 se o arquivo não der para medir e None se o
+    # próprio ffprobe não rodou (resultado desconhecido, não arquivo ruim)
+    try:
+        with TRACER.span("ffprobe", "process", file=path):
+            result = subprocess.run(
+                ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+                 "-of", "default=noprint_wrappers=1:nokey=1", path],
+                capture_output=True, text=True,
+            )
+    except OSError:
+        return None
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return 0.0
+
+
+def duration_mismatch(actual: float, expected: Optional[float]) -> bool:
+    if not expected:
+        return False
+    return abs(actual - expected) > max(DURATION_TOLERANCE * expected, 2.0)
+
+
+def bytes_mismatch(size: int, probe: dict, tolerance: float) -> Optional[str]:
+    # Compara os bytes recebidos com banda × soma dos EXTINF. AVERAGE-BANDWIDTH é a taxa
+    # média, então vale a tolerância para os dois lados; BANDWIDTH sozinho é o pico e só
+    # serve de teto
+    duration = probe["duration"]
+    if probe.get("average_bandwidth"):
+        expected = probe["average_bandwidth"] / 8 * duration
+        if abs(size - expected) > tolerance * expected:
+            return f"{size / 1e6:.1f} MB recebidos, esperados ~{expected / 1e6:.1f} MB"
+    elif probe.get("bandwidth"):
+        ceiling = probe["bandwidth"] / 8 * duration
+        if size > (1 + tolerance) * ceiling:
+            return f"{size / 1e6:.1f} MB recebidos, acima do máximo de ~{ceiling / 1e6:.1f} MB"
+    return None
+
+
+class SegmentManifest:
+    # Registra quais segmentos já estão completos (e com qual tamanho) na pasta de staging
+    def __init__(self, folder: Path):
+        self.path = folder / "manifest.json"
+        self._lock = threading.Lock()
+        self.segments = {}
+        if self.path.exists():
+            try:
+                self.segments = json.loads(self.path.read_text()).get("segments", {})
+            except (OSError, ValueError):
+                self.segments = {}
+
+    def locate(self, filename: str) -> Path:
+        return STAGING.locate(self.path.parent.name, filename)
+
+    def segment_path(self, filename: str) -> Path:
+        # Onde gravar um segmento novo (memória ou disco), decidido quando o download começa
+        return STAGING.target(self.path.parent.name, filename)
+
+    def is_complete(self, filename: str) -> bool:
+        size = self.segments.get(filename)
+        file_path = self.locate(filename)
+        return size is not None and file_path.exists() and file_path.stat().st_size == size
+
+    def local_playlist(self) -> Path:
+        # Playlist para o ffmpeg com o caminho absoluto de cada segmento, em memória ou em disco
+        source = self.path.parent / "playlist.m3u8"
+        target = self.path.parent / "playlist.local.m3u8"
+        lines = [
+            str(self.locate(line).resolve()) if line and not line.startswith("#") else line
+            for line in source.read_text().splitlines()
+        ]
+        target.write_text("\n".join(lines) + "\n")
+        return target
+
+    def missing(self, filenames: list) -> list:
+        return [filename for filename in filenames if not self.is_complete(filename)]
+
+    def mark_complete(self, filename: str, size: int):
+        STAGING.stored(self.locate(filename), size)
+        with self._lock:
+            self.segments[filename] = size
+            temp_path = self.path.with_suffix(".tmp")
+            temp_path.write_text(json.dumps({"segments": self.segments}))
+            os.replace(temp_path, self.path)
+
+
+class SegmentStaging:
+    # Segmentos do modo temp: cada processo usa STAGING_MEMORY_DIR/<pid> até o teto de memória
+    # e STAGING_DIR a partir daí. O que sobra em memória (ffmpeg falhou, download incompleto ou
+    # fim do processo) é levado para o disco, então a retomada continua funcionando.
+    def __init__(self, folder: Path = STAGING_DIR, memory_folder: str = STAGING_MEMORY_DIR,
+                 memory_limit: str = STAGING_MEMORY_LIMIT):
+        self.folder = Path(folder)
+        self.memory_root = Path(memory_folder) if memory_folder else None
+        self.memory_limit = parse_rate(memory_limit)
+        self.memory_folder = None
+        self.memory_used = 0
+        self._lock = threading.Lock()
+        self._ready = False
+        atexit.register(self.spill_all)
+
+    def _prepare(self):
+        # No primeiro uso (busca ou gravação): cria a pasta em memória deste processo, limita o teto a metade
+        # do espaço livre (o /dev/shm do Docker tem 64 MB) e devolve ao disco o que processos
+        # encerrados deixaram para trás
+        self._ready = True
+        if self.memory_root is None or self.memory_limit <= 0:
+            return
+        try:
+            self.memory_root.mkdir(parents=True, exist_ok=True)
+            self.memory_limit = min(self.memory_limit, shutil.disk_usage(self.memory_root).free // 2)
+            for stale in self.memory_root.iterdir():
+                if stale.name.isdigit() and not LessonIndex._alive(int(stale.name)):
+                    self._spill_folder(stale)
+            self.memory_folder = self.memory_root / str(os.getpid())
+        except OSError as e:
+            print(f"Staging em memória indisponível ({e}); usando {self.folder}")
+
+    def _ensure_ready(self):
+        with self._lock:
+            if not self._ready:
+                self._prepare()
+
+    def locate(self, name: str, filename: str) -> Path:
+        # Prepara antes de procurar: segmentos deixados em memória por um processo que morreu
+        # já estão no disco quando a retomada confere o manifesto
+        self._ensure_ready()
+        if self.memory_folder is not None:
+            path = self.memory_folder / name / filename
+            if path.exists():
+                return path
+        return self.folder / name / filename
+
+    def target(self, name: str, filename: str) -> Path:
+        self._ensure_ready()
+        with self._lock:
+            in_memory = self.memory_folder is not None and self.memory_used < self.memory_limit
+        folder = (self.memory_folder if in_memory else self.folder) / name
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder / filename
+
+    def stored(self, path: Path, size: int):
+        if self.memory_folder is not None and self.memory_folder in path.parents:
+            with self._lock:
+                self.memory_used += size
+
+    def _spill_folder(self, process_folder: Path):
+        for folder in list(process_folder.iterdir()):
+            target = self.folder / folder.name
+            target.mkdir(parents=True, exist_ok=True)
+            for path in folder.iterdir():
+                shutil.move(str(path), str(target / path.name))
+            folder.rmdir()
+        process_folder.rmdir()
+
+    def spill(self, name: str):
+        # Leva para o disco os segmentos do vídeo que estão em memória
+        if self.memory_folder is None or not (self.memory_folder / name).exists():
+            return
+        folder = self.memory_folder / name
+        target = self.folder / name
+        target.mkdir(parents=True, exist_ok=True)
+        freed = 0
+        for path in folder.iterdir():
+            if not path.name.endswith(".part"):
+                freed += path.stat().st_size
+                shutil.move(str(path), str(target / path.name))
+        shutil.rmtree(folder, ignore_errors=True)
+        with self._lock:
+            self.memory_used = max(0, self.memory_used - freed)
+
+    def remove(self, name: str):
+        # Apaga segmentos, manifesto e playlists do vídeo nas duas pastas
+        if self.memory_folder is not None and (self.memory_folder / name).exists():
+            freed = sum(path.stat().st_size for path in (self.memory_folder / name).iterdir())
+            shutil.rmtree(self.memory_folder / name, ignore_errors=True)
+            with self._lock:
+                self.memory_used = max(0, self.memory_used - freed)
+        shutil.rmtree(self.folder / name, ignore_errors=True)
+        try:
+            self.folder.rmdir()
+        except OSError:
+            pass
+
+    def spill_all(self):
+        if self.memory_folder is None or not self.memory_folder.exists():
+            return
+        for folder in list(self.memory_folder.iterdir()):
+            self.spill(folder.name)
+        try:
+            self.memory_folder.rmdir()
+        except OSError:
+            pass
+
+
+STAGING = SegmentStaging()
+
+
+class SegmentStreamer:
+    # Baixa os segmentos em paralelo e os entrega em ordem para um único ffmpeg
+    # via stdin, remuxando enquanto o download acontece
+    def __init__(self, save_path: str, threads_count: int = SEGMENT_THREADS_MAX, window: int = STREAM_WINDOW):
+        self.save_path = save_path
+        self.threads_count = threads_count
+        self.window = max(window, threads_count)
+        # Segmentos e bytes entregues ao ffmpeg, usados na verificação
+        self.segments = 0
+        self.bytes = 0
+
+    def _feed_threads(self, urls: list, fetch, write) -> Optional[str]:
+        jobs = queue.Queue()
+        for index, url in enumerate(urls):
+            jobs.put((index, url))
+
+        pending = {}
+        state = {"next": 0, "error": None}
+        condition = threading.Condition()
+
+        def worker():
+            while True:
+                try:
+                    index, url = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                # Não busca segmentos muito à frente do que o ffmpeg já consumiu
+                with condition:
+                    condition.wait_for(lambda: state["error"] or index < state["next"] + self.window)
+                    if state["error"]:
+                        return
+                try:
+                    data = fetch(url)
+                except Exception as e:
+                    with condition:
+                        state["error"] = state["error"] or f"segmento {index}: {e}"
+                        condition.notify_all()
+                    return
+                with condition:
+                    pending[index] = data
+                    condition.notify_all()
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.threads_count)]
         for thread in threads:
-            thread.join()
+            thread.start()
 
-        segment_queue.join()
+        try:
+            for index in range(len(urls)):
+                with condition:
+                    condition.wait_for(lambda: state["error"] or index in pending)
+                    if state["error"]:
+                        break
+                    data = pending.pop(index)
+                try:
+                    write(index, data)
+                except OSError as e:
+                    with condition:
+                        state["error"] = f"ffmpeg encerrou durante o envio: {e}"
+                        condition.notify_all()
+                    break
+                with condition:
+                    state["next"] = index + 1
+                    condition.notify_all()
+        finally:
+            with condition:
+                state["error"] = state["error"] or (None if state["next"] == len(urls) else "interrompido")
+                condition.notify_all()
+            for thread in threads:
+                thread.join()
+        return state["error"]
 
-        print("\nDownload concluído!\n")
+    def run(self, urls: list, fetch, engine=None) -> bool:
+        part_path = f"{self.save_path}.part"
+        try:
+            ffmpeg = subprocess.Popen(
+                ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-f", "mpegts", "-i", "pipe:0",
+                 "-c", "copy", "-bsf:a", "aac_adtstoasc", "-f", "mp4", part_path],
+                stdin=subprocess.PIPE,
+            )
+        except OSError as e:
+            print(f"Não foi possível iniciar o ffmpeg: {e}")
+            return False
 
-        self.__convert_segments()
+        def write(index, data):
+            ffmpeg.stdin.write(data)
+            self.segments += 1
+            self.bytes += len(data)
+            progress(f"Enviando segmento {index + 1} de {len(urls)} para o ffmpeg... ")
 
-    def download(self):
-        if os.path.exists(self.save_path):
-            print("\tArquivo já existe. Pulando download.")
-            return
-        print(f"Iniciando download do vídeo: {self.video_id}")
-        playlists_url = f"https://{self.domain}/{self.video_id}/playlist.m3u8"
-        playlists_content = self.session.get(playlists_url).text
-        playlists_loaded = m3u8.loads(playlists_content)
-
-        best_playlist = max(
-            playlists_loaded.playlists,
-            key=lambda x: x.stream_info.resolution[0] * x.stream_info.resolution[1],
-        )
-        best_playlist_url = (
-            best_playlist.uri
-            if best_playlist.uri.startswith("http")
-            else f"https://{self.domain}/{self.video_id}/{best_playlist.uri}"
-        )
+        error = "interrompido"
+        try:
+            with TRACER.span("ffmpeg stream", "process", file=self.save_path, segments=len(urls)):
+                if engine is not None:
+                    error = engine.fetch_ordered(urls, self.window, write)
+                else:
+                    error = self._feed_threads(urls, fetch, write)
+        finally:
+            try:
+                ffmpeg.stdin.close()
+            except OSError:
+                pass
+            if error:
+                ffmpeg.kill()
+            ffmpeg.wait()
+
+        if error or ffmpeg.returncode != 0:
+            print(f"\nFalha no modo streaming: {error or f'ffmpeg retornou {ffmpeg.returncode}'}")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return False
 
-        self.__download_playlist(best_playlist_url)
+        os.replace(part_path, self.save_path)
+        print("\nDownload e conversão concluídos!\n")
+        return True
 
 
-class CDNVideo:
-    def __init__(self, video_id: str, save_path: str, threads_count=10):
-        self.video_id = video_id
-        self.domain = "vz-dc851587-83d.b-cdn.net"
-        self.session = requests.session()
-        self.session.headers.update({
+@contextlib.asynccontextmanager
+async def async_connection_slot():
+    # O mesmo teto global (CONNECTION_SLOTS) dos motores com threads, sem bloquear o loop
+    while not CONNECTION_SLOTS.acquire(blocking=False):
+        await asyncio.sleep(0.005)
+    try:
+        yield
+    finally:
+        CONNECTION_SLOTS.release()
+
+
+class AsyncLoop:
+    # Um único event loop por processo, em uma thread própria, com uma ClientSession (e o
+    # pool de conexões keep-alive dela) e um semáforo por host compartilhados por todas as
+    # aulas: os limites valem para o processo inteiro, não para cada vídeo
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loop = None
+        self.session = None
+        self.hosts = {}
+        self.per_host = max(1, min(ASYNC_HOST_LIMIT, MAX_CONNECTIONS))
+
+    def run(self, coroutine):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="asyncio", daemon=True).start()
+                atexit.register(self.close)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def client(self):
+        # Só é chamado de dentro do loop, então não precisa de lock
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=self.per_host)
+            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    def host(self, host: str):
+        return self.hosts.setdefault(host, asyncio.Semaphore(self.per_host))
+
+    def close(self):
+        async def close_session():
+            if self.session is not None:
+                await self.session.close()
+        self.run(close_session())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+ASYNC_LOOP = AsyncLoop()
+
+
+class AsyncSegmentFetcher:
+    # Motor alternativo (SEGMENT_ENGINE=asyncio): centenas de requisições simultâneas em
+    # uma única thread (ASYNC_LOOP), limitadas por host e por CONNECTION_SLOTS
+    def __init__(self, headers: dict, metrics: Optional[LessonMetrics] = None):
+        if aiohttp is None:
+            raise RuntimeError("SEGMENT_ENGINE=asyncio requer o pacote aiohttp")
+        self.headers = headers
+        self.metrics = metrics
+
+    async def _fetch(self, url: str, retries: int = SEGMENT_RETRIES, path=None):
+        # Como controlled_fetch: com `path` grava em blocos de CHUNK_SIZE e devolve o tamanho
+        host = urlparse(url).netloc
+        lesson = self.metrics.lesson if self.metrics is not None else None
+        with TRACER.span("segment", "segment", overlapping=True, host=host, lesson=lesson) as trace:
+            return await self.__fetch(ASYNC_LOOP.client(), ASYNC_LOOP.host(host), url, retries, path, trace)
+
+    async def __fetch(self, session, semaphore, url: str, retries: int, path, trace: dict):
+        for attempt in range(retries + 1):
+            headers = None
+            status = None
+            size = 0
+            started = time.monotonic()
+            try:
+                async with semaphore, async_connection_slot():
+                    async with session.get(url, headers=self.headers) as response:
+                        headers = response.headers
+                        status = response.status
+                        if response.status in RETRY_STATUS and attempt < retries:
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, response.history, status=response.status)
+                        response.raise_for_status()
+                        if path is None:
+                            data = await response.read()
+                            size = len(data)
+                        else:
+                            # Blocos pequenos em disco local: a escrita direta não segura o loop
+                            # `path` pode ser uma função: o destino só é decidido quando o segmento começa
+                            path = path() if callable(path) else path
+                            size = 0
+                            part_path = f"{path}.part"
+                            try:
+                                with open(part_path, "wb") as file:
+                                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                                        file.write(chunk)
+                                        size += len(chunk)
+                            except BaseException:
+                                if os.path.exists(part_path):
+                                    os.remove(part_path)
+                                raise
+                            os.replace(part_path, path)
+                            data = size
+                METRICS.record_request(url, time.monotonic() - started, size, status, retried=attempt > 0)
+                if self.metrics is not None:
+                    self.metrics.add_segment(size)
+                await asyncio.sleep(BANDWIDTH.reserve(size))
+                trace["bytes"] = size
+                return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                METRICS.record_request(url, time.monotonic() - started, 0, status, retried=attempt > 0)
+                status = getattr(e, "status", status)
+                if attempt == retries or (status is not None and status not in RETRY_STATUS):
+                    raise
+                if self.metrics is not None:
+                    self.metrics.add_retry()
+                await asyncio.sleep(retry_delay(attempt, headers))
+
+    def fetch_all(self, jobs: list, done) -> dict:
+        # jobs: [(chave, url, caminho ou função que o devolve)]; cada segmento é gravado em blocos no seu caminho e
+        # done(chave, tamanho) é chamado ao terminar. Retorna {chave: erro} dos que falharam.
+        async def main():
+            loop = asyncio.get_running_loop()
+            errors = {}
+
+            async def one(key, url, path):
+                try:
+                    size = await self._fetch(url, path=path)
+                    await loop.run_in_executor(None, done, key, size)
+                except Exception as e:
+                    errors[key] = str(e)
+            await asyncio.gather(*(one(key, url, path) for key, url, path in jobs))
+            return errors
+        return ASYNC_LOOP.run(main())
+
+    def fetch_ordered(self, urls: list, window: int, write) -> Optional[str]:
+        # Mantém no máximo `window` segmentos em voo e entrega em ordem para write(indice, dados)
+        async def main():
+            loop = asyncio.get_running_loop()
+            tasks = collections.deque()
+            next_to_schedule = 0
+            try:
+                for index in range(len(urls)):
+                    while next_to_schedule < len(urls) and len(tasks) < window:
+                        tasks.append(asyncio.ensure_future(self._fetch(urls[next_to_schedule])))
+                        next_to_schedule += 1
+                    try:
+                        data = await tasks.popleft()
+                    except Exception as e:
+                        return f"segmento {index}: {e}"
+                    try:
+                        await loop.run_in_executor(None, write, index, data)
+                    except OSError as e:
+                        return f"ffmpeg encerrou durante o envio: {e}"
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            return None
+        return ASYNC_LOOP.run(main())
+
+
+# Fontes HLS na ordem de preferência. Só isto muda entre elas: host, cabeçalhos, URL da
+# playlist master, política de variante ("quality", padrão VIDEO_QUALITY) e, opcionalmente,
+# "resolve(base, uri)" para URIs relativas (padrão urljoin)
+HLS_PROVIDERS = {
+    "panda": {
+        "domain": "b-vz-762f4670-e04.tv.pandavideo.com.br",
+        "headers": {
+            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+            "Accept": "*/*",
+            "Accept-Language": "en-US,en;q=0.9",
+            "Origin": "https://app.rocketseat.com.br",
+            "Referer": "https://app.rocketseat.com.br/",
+        },
+    },
+    "cdn": {
+        "domain": "vz-dc851587-83d.b-cdn.net",
+        "headers": {
             "accept": "*/*",
             "accept-language": "pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7,it;q=0.6",
             "dnt": "1",
@@ -221,222 +2079,392 @@ class CDNVideo:
             "sec-fetch-dest": "empty",
             "sec-fetch-mode": "cors",
             "sec-fetch-site": "cross-site",
-            "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36"
-        })
+            "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36",
+        },
+    },
+}
+if HLS_PROVIDERS_FILE:
+    HLS_PROVIDERS.update(json.loads(Path(HLS_PROVIDERS_FILE).read_text(encoding="utf-8")))
+
+
+class HLSVideo:
+    # Motor único de download HLS: pool de conexões, novas tentativas, streaming para o
+    # ffmpeg, pasta temporária com retomada e métricas valem para qualquer fonte de HLS_PROVIDERS
+    def __init__(self, provider: str, video_id: str, save_path: str, threads_count=SEGMENT_THREADS_MAX):
+        spec = HLS_PROVIDERS[provider]
+        self.name = provider
+        self.video_id = video_id
+        self.domain = spec["domain"]
+        self.scheme = spec.get("scheme", "https")
+        self.master = spec.get("master", "{scheme}://{domain}/{video_id}/playlist.m3u8")
+        self.headers = spec["headers"]
+        self.quality = str(spec.get("quality", VIDEO_QUALITY)).strip().lower().rstrip("p")
+        self.resolve = spec.get("resolve", urljoin)
         self.save_path = save_path
         self.threads_count = threads_count
-
-    def _create_temp_folder(self):
-        foldername = "".join(random.choices("ABCDEFGHIJKLMNOPQRSTUVWXYZ", k=5))
-        self.temp_folder = Path(".temp") / foldername
-        if not os.path.exists(self.temp_folder):
-            os.makedirs(self.temp_folder)
+        self.metrics = None
+        # Segmentos e bytes do último download completo ({"segments", "bytes"})
+        self.fetched = None
+
+    def _get(self, url: str, stream: bool = False) -> requests.Response:
+        session = HTTP_POOL.session_for(url, self.threads_count)
+        if stream:
+            # Quem pede o corpo em blocos segura a vaga de conexão até terminar de lê-lo
+            return session.get(url, headers=self.headers, timeout=REQUEST_TIMEOUT, stream=True)
+        with CONNECTION_SLOTS:
+            return session.get(url, headers=self.headers, timeout=REQUEST_TIMEOUT)
+
+    def _async_engine(self) -> Optional["AsyncSegmentFetcher"]:
+        return AsyncSegmentFetcher(self.headers, metrics=self.metrics) if SEGMENT_ENGINE == "asyncio" else None
+
+    def _create_temp_folder(self, variant: str):
+        self.temp_folder = staging_folder(self.name, self.video_id, variant)
+        self.temp_folder.mkdir(parents=True, exist_ok=True)
+        self.manifest = SegmentManifest(self.temp_folder)
         return self.temp_folder
 
-    def __convert_segments(self):
-        ffmpeg_cmd = f'ffmpeg -hide_banner -loglevel error -stats -y -i "{self.temp_folder}/playlist.m3u8" -c copy -bsf:a aac_adtstoasc "{self.save_path}"'
-        os.system(ffmpeg_cmd)
-        for filename in os.listdir(self.temp_folder):
-            os.remove(self.temp_folder / filename)
-        os.removedirs(self.temp_folder)
+    def remux(self) -> bool:
+        # Estágio de remux: converte a pasta temporária deixada por fetch() no .mp4 final
+        if not remux_playlist(self.manifest.local_playlist(), self.save_path):
+            # Mantém os segmentos (em disco) para que a próxima execução só refaça a conversão
+            STAGING.spill(self.temp_folder.name)
+            print(f"Falha na conversão; segmentos mantidos em {self.temp_folder}")
+            if os.path.exists(self.save_path):
+                os.remove(self.save_path)
+            return False
+        STAGING.remove(self.temp_folder.name)
+        return True
+
+    def _fetch_segment(self, url: str) -> bytes:
+        return controlled_fetch(self._get, url, metrics=self.metrics)
+
+    def _download_segment(self, url: str, path: Path) -> int:
+        return controlled_fetch(self._get, url, metrics=self.metrics, path=path)
+
+    def _download_segments(self, segments: list):
+        # Baixa para a pasta temporária os segmentos que o manifesto ainda não tem
+        engine = self._async_engine()
+        if engine is not None:
+            jobs = [
+                (segment.uri.split("/")[-1], segment.uri,
+                 functools.partial(self.manifest.segment_path, segment.uri.split("/")[-1]))
+                for segment in segments
+            ]
+            for filename, error in engine.fetch_all(jobs, self.manifest.mark_complete).items():
+                print(f"\nErro ao baixar segmento {filename}: {error}")
+            return
 
-    def __download_playlist(self, playlist_url: str):
-        print("Iniciando o download dos segmentos...")
-        self._create_temp_folder()
-        
-        try:
-            # Baixar a playlist principal
-            response = self.session.get(playlist_url)
-            response.raise_for_status()
-            playlist_content = response.text
-            print(f"Conteúdo da playlist principal:\n{playlist_content}")
-            
-            # Carregar a playlist principal
-            main_playlist = m3u8.loads(playlist_content)
-            
-            # Se for uma playlist master (contém outras playlists)
-            if main_playlist.playlists:
-                print("Playlist master encontrada, selecionando segunda melhor qualidade...")
-                # Ordenar as playlists por qualidade
-                sorted_playlists = sorted(
-                    main_playlist.playlists,
-                    key=lambda x: x.stream_info.resolution[0] * x.stream_info.resolution[1],
-                    reverse=True
-                )
-                
-                # Selecionar a segunda melhor qualidade
-                if len(sorted_playlists) > 1:
-                    second_best_playlist = sorted_playlists[1]
-                    print(f"Selecionada segunda melhor qualidade: {second_best_playlist.stream_info.resolution[0]}x{second_best_playlist.stream_info.resolution[1]}")
-                else:
-                    # Se só tiver uma qualidade, usa ela
-                    second_best_playlist = sorted_playlists[0]
-                    print(f"Usando única qualidade disponível: {second_best_playlist.stream_info.resolution[0]}x{second_best_playlist.stream_info.resolution[1]}")
-                
-                # Baixar a playlist de qualidade específica
-                quality_playlist_url = second_best_playlist.uri
-                if not quality_playlist_url.startswith('http'):
-                    quality_playlist_url = f"https://{self.domain}/{self.video_id}/{quality_playlist_url}"
-                
-                print(f"Baixando playlist de qualidade: {quality_playlist_url}")
-                response = self.session.get(quality_playlist_url)
-                response.raise_for_status()
-                quality_playlist_content = response.text
-                print(f"Conteúdo da playlist de qualidade:\n{quality_playlist_content}")
-                
-                playlist = m3u8.loads(quality_playlist_content)
-            else:
-                # Se já for uma playlist de segmentos
-                playlist = main_playlist
-            
-            print(f"Playlist carregada com {len(playlist.segments)} segmentos")
-            
-            # Salvar a playlist final
-            with open(self.temp_folder / "playlist.m3u8", "w") as file:
-                file.write(playlist.dumps())
-            
-            threads = []
-            segment_queue = queue.Queue()
-            self.downloaded_segments = 0
-            self.total_segments = len(playlist.segments)
-            
-            # Ordenar os segmentos para garantir a ordem correta
-            def get_segment_number(segment):
-                filename = segment.uri.split('/')[-1]
-                if filename.startswith('video'):
-                    try:
-                        return int(filename[5:-3])
-                    except:
-                        return 0
-                return 0
-            
-            sorted_segments = sorted(playlist.segments, key=get_segment_number)
-            for segment in sorted_segments:
-                segment_queue.put(segment)
+        segment_queue = queue.Queue()
+        for segment in segments:
+            segment_queue.put(segment)
 
-            def worker():
-                while not segment_queue.empty():
-                    segment = segment_queue.get()
-                    try:
-                        # Atualizar headers para cada segmento
-                        segment_headers = {
-                            "sec-ch-ua-platform": '"Linux"',
-                            "Referer": "https://iframe.mediadelivery.net/",
-                            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36",
-                            "sec-ch-ua": '"Google Chrome";v="135", "Not-A.Brand";v="8", "Chromium";v="135"',
-                            "DNT": "1",
-                            "sec-ch-ua-mobile": "?0"
-                        }
-                        self.session.headers.update(segment_headers)
-                        
-                        segment_url = segment.uri
-                        if not segment_url.startswith('http'):
-                            segment_url = f"https://{self.domain}/{self.video_id}/1080p/{segment_url}"
-                        
-                        print(f"Baixando segmento: {segment_url}")
-                        response = self.session.get(segment_url)
-                        response.raise_for_status()
-                        filename = segment.uri.split("/")[-1]
-                        file_path = self.temp_folder / filename
-                        with open(file_path, "wb") as file:
-                            file.write(response.content)
-                        print(f"Segmento {filename} baixado com sucesso")
-                        segment_queue.task_done()
+        def worker():
+            while True:
+                try:
+                    segment = segment_queue.get_nowait()
+                except queue.Empty:
+                    return
+                filename = segment.uri.split("/")[-1]
+                try:
+                    size = self._download_segment(segment.uri, self.manifest.segment_path(filename))
+                    self.manifest.mark_complete(filename, size)
+                    with self._progress_lock:
                         self.downloaded_segments += 1
-                        print(
-                            f"\rBaixando segmento {self.downloaded_segments} de {self.total_segments}... ",
-                            end="",
-                            flush=True,
-                        )
-                    except Exception as e:
-                        print(f"\nErro ao baixar segmento {segment_url}: {str(e)}")
-                        segment_queue.task_done()
+                        progress(f"Baixando segmento {self.downloaded_segments} de {self.total_segments}... ")
+                except Exception as e:
+                    print(f"\nErro ao baixar segmento {filename}: {str(e)}")
 
-            for _ in range(self.threads_count):
-                thread = threading.Thread(target=worker)
-                thread.start()
-                threads.append(thread)
+        self._progress_lock = threading.Lock()
+        threads = [threading.Thread(target=worker) for _ in range(min(self.threads_count, len(segments)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-            for thread in threads:
-                thread.join()
+    def __download_playlist(self, playlist_content: str, variant: str):
+        print("Iniciando o download dos segmentos...")
+        playlist = m3u8.loads(playlist_content)
 
-            segment_queue.join()
+        # Um manifesto existente indica download interrompido: retoma pela pasta temporária
+        resuming = (staging_folder(self.name, self.video_id, variant) / "manifest.json").exists()
+        if HLS_MODE == "stream" and is_streamable(playlist) and not resuming:
+            urls = [segment.uri for segment in playlist.segments]
+            streamer = SegmentStreamer(self.save_path, self.threads_count)
+            if streamer.run(urls, self._fetch_segment, self._async_engine()):
+                self.fetched = {"segments": streamer.segments, "bytes": streamer.bytes}
+                return "verify"
+            print("Usando a pasta temporária como alternativa...")
+
+        self._create_temp_folder(variant)
+        # Playlist local apontando para os nomes dos segmentos
+        with open(self.temp_folder / "playlist.m3u8", "w") as file:
+            for line in playlist_content.splitlines():
+                line = line.split("/")[-1] if line.startswith("http") else line
+                file.write(f"{line}\n")
 
-            print("\nDownload concluído!\n")
-            print(f"Verificando arquivos baixados em {self.temp_folder}")
-            for f in os.listdir(self.temp_folder):
-                print(f"Arquivo encontrado: {f}")
+        filenames = [segment.uri.split("/")[-1] for segment in playlist.segments]
+        pending = [segment for segment, filename in zip(playlist.segments, filenames)
+                   if not self.manifest.is_complete(filename)]
+        self.total_segments = len(filenames)
+        self.downloaded_segments = self.total_segments - len(pending)
+        if self.downloaded_segments:
+            print(f"Retomando download: {self.downloaded_segments} de {self.total_segments} segmentos já baixados")
+        self._download_segments(pending)
+        print("\nDownload concluído!\n")
 
-            self.__convert_segments()
-            return True
-            
-        except Exception as e:
-            print(f"Erro ao processar playlist: {str(e)}")
+        # Nunca converte uma playlist com buracos: os segmentos que faltam ficam para a próxima execução
+        missing = self.manifest.missing(filenames)
+        if missing:
+            STAGING.spill(self.temp_folder.name)
+            print(f"{len(missing)} segmentos não foram baixados; segmentos mantidos em {self.temp_folder}")
             return False
 
-    def download(self):
+        self.fetched = {"segments": len(filenames), "bytes": sum(self.manifest.segments[name] for name in filenames)}
+        return "remux"
+
+    def _load_variant(self):
+        master_url = self.master.format(scheme=self.scheme, domain=self.domain, video_id=self.video_id)
+        return load_variant(self._get, master_url, self.quality, self.resolve)
+
+    def probe(self) -> dict:
+        return probe_playlist(self.name, self._load_variant)
+
+    def fetch(self, probe: Optional[dict] = None):
+        # Estágio de rede: "remux" se os segmentos ficaram na pasta temporária,
+        # "verify" se o .mp4 já está pronto e False se o download falhou
         if os.path.exists(self.save_path):
             print("\tArquivo já existe. Pulando download.")
-            return
+            return "verify"
+        print(f"Iniciando download do vídeo {self.video_id} ({self.name})")
+        if probe is None:
+            playlist_content, variant, _ = self._load_variant()
+        else:
+            playlist_content, variant = probe["content"], probe["variant"]
+        return self.__download_playlist(playlist_content, variant)
+
+    def download(self, probe: Optional[dict] = None):
+        stage = self.fetch(probe)
+        return self.remux() if stage == "remux" else bool(stage)
 
-        print(f"Iniciando download do vídeo: {self.video_id}")
-        
-        # Tentar primeiro a playlist direta
-        playlists_url = f"https://{self.domain}/{self.video_id}/playlist.m3u8"
-        success = self.__download_playlist(playlists_url)
-        
-        if not success:
-            print("Não foi possível baixar o vídeo do CDN.")
 
 class VideoDownloader:
-    def __init__(self, video_id: str, save_path: str, threads_count=10):
+    def __init__(self, video_id: str, save_path: str, threads_count=SEGMENT_THREADS_MAX,
+                 metrics: Optional[LessonMetrics] = None, expected_duration: Optional[float] = None):
         self.video_id = video_id
         self.save_path = save_path
         self.threads_count = threads_count
-        self.panda = PandaVideo(video_id, save_path, threads_count)
-        self.cdn = CDNVideo(video_id, save_path, threads_count)
+        self.metrics = metrics
+        # Duração da aula segundo a API, em segundos
+        self.expected_duration = expected_duration
+        self.providers = {name: HLSVideo(name, video_id, save_path, threads_count) for name in HLS_PROVIDERS}
+        for provider in self.providers.values():
+            provider.metrics = metrics
+        self.probes = {}
+        self.candidates = []
+        self.provider = None
+        self.duration = None
+
+    def _span(self, name: str):
+        return TRACER.span(name, "video", video=self.video_id, provider=self.provider,
+                           lesson=self.metrics.lesson if self.metrics is not None else None)
+
+    def __probe(self) -> dict:
+        # Sonda todos os provedores ao mesmo tempo, antes de baixar qualquer segmento. Sem
+        # cache: um vídeo repetido na execução já vem do store, sem sondar de novo
+        with ThreadPoolExecutor(max_workers=len(self.providers)) as executor:
+            futures = {name: executor.submit(provider.probe) for name, provider in self.providers.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def probe(self) -> list:
+        # Estágio de metadados: define em que ordem os provedores serão tentados
+        with self._span("probe"):
+            self.probes = self.__probe()
+        # A ordem de HLS_PROVIDERS é a preferência (Panda primeiro quando os dois têm o vídeo)
+        self.candidates = []
+        for name in self.providers:
+            probe = self.probes[name]
+            if not probe["ok"]:
+                print(f"{name}: playlist indisponível {probe.get('error', '(vídeo muito curto ou sem segmentos)')}")
+            elif duration_mismatch(probe["duration"], self.expected_duration):
+                # Não adianta baixar algo que a verificação vai recusar
+                print(f"{name}: playlist com {probe['duration']:.0f}s, mas a aula tem {self.expected_duration}s")
+            else:
+                print(f"{name}: {probe['segments']} segmentos, {probe['duration']:.2f} segundos ({probe['variant']})")
+                self.candidates.append(name)
+        return self.candidates
+
+    def fetch(self) -> Optional[str]:
+        # Estágio de rede: tenta os provedores restantes até um deles entregar os segmentos.
+        # Retorna o próximo estágio ("remux" ou "verify") ou None se nenhum conseguiu.
+        while self.candidates:
+            self.provider = self.candidates.pop(0)
+            print(f"Tentando download com {self.provider}...")
+            try:
+                with self._span("fetch"):
+                    stage = self.providers[self.provider].fetch(self.probes[self.provider])
+            except Exception as e:
+                print(f"Erro ao baixar com {self.provider}: {e}")
+                continue
+            if stage:
+                return stage
+        print("Não foi possível baixar o vídeo de nenhum dos provedores disponíveis.")
+        return None
+
+    def remux(self) -> bool:
+        with self._span("remux"):
+            return self.providers[self.provider].remux()
+
+    def __check(self) -> Optional[str]:
+        # Confere o resultado com o que o download já sabe, sem abrir processo nenhum: todos os
+        # segmentos da playlist chegaram e a soma dos EXTINF bate com a duração da aula na API;
+        # os bytes são comparados com a banda anunciada da variante (ver BYTES_TOLERANCE)
+        if not os.path.exists(self.save_path) or os.path.getsize(self.save_path) == 0:
+            return "arquivo final ausente ou vazio"
+        if self.provider is None:
+            # Arquivo que já existia antes desta execução: não há números do download, então só
+            # passa se o ffprobe já mediu uma duração válida (ver _stage_metadata)
+            if not self.duration:
+                return "arquivo existente sem duração medida"
+            return None
+        probe = self.probes[self.provider]
+        fetched = self.providers[self.provider].fetched or {}
+        self.duration = probe["duration"]
+        if fetched.get("segments") != probe["segments"]:
+            return f"{fetched.get('segments', 0)} de {probe['segments']} segmentos recebidos"
+        if not fetched.get("bytes"):
+            return "nenhum byte recebido"
+        # A banda anunciada é do empacotador (e pode incluir áudio separado): por padrão só avisa
+        problem = bytes_mismatch(fetched["bytes"], probe, BYTES_TOLERANCE or DURATION_TOLERANCE)
+        if problem:
+            if BYTES_TOLERANCE > 0:
+                return problem
+            print(f"\tAviso: {problem}")
+        if duration_mismatch(self.duration, self.expected_duration):
+            return f"a playlist tem {self.duration:.0f}s e a aula tem {self.expected_duration}s"
+        return None
+
+    def verify(self) -> bool:
+        with self._span("verify"):
+            problem = self.__check()
+            duration = (probe_duration(self.save_path) or 0.0) if problem is None and DEEP_VERIFY else None
+        if duration is not None:
+            if duration <= MIN_VIDEO_DURATION:
+                problem = f"ffprobe mediu {duration:.2f} segundos"
+            elif duration_mismatch(duration, self.expected_duration or self.duration):
+                problem = f"ffprobe mediu {duration:.0f}s, esperado {self.expected_duration or self.duration:.0f}s"
+            else:
+                self.duration = duration
 
-    def __check_video_duration(self):
-        try:
-            cmd = f'ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{self.save_path}"'
-            duration = float(os.popen(cmd).read().strip())
-            return duration
-        except:
-            return 0
+        if problem is None:
+            if self.duration:
+                print(f"Vídeo baixado com sucesso! Duração: {self.duration:.2f} segundos")
+            if self.metrics is not None:
+                self.metrics.provider = self.provider
+            return True
+
+        print(f"Verificação falhou: {problem}")
+        self.duration = None
+        if os.path.exists(self.save_path):
+            os.remove(self.save_path)
+        return False
 
     def download(self):
+        # Os mesmos estágios em sequência, na thread de quem chama
         if os.path.exists(self.save_path):
             print("\tArquivo já existe. Pulando download.")
-            return
+            return True
 
-        # Tentar primeiro com o Panda
-        print("Tentando download com Panda...")
-        self.panda.download()
-        
-        # Verificar duração do vídeo
-        duration = self.__check_video_duration()
-        if duration > 10:  # Se o vídeo tem mais de 10 segundos, consideramos válido
-            print(f"Vídeo baixado com sucesso! Duração: {duration:.2f} segundos")
-            return
-        
-        print(f"Vídeo muito curto ({duration:.2f} segundos). Tentando CDN...")
-        if os.path.exists(self.save_path):
-            os.remove(self.save_path)
-        
-        # Tentar com o CDN
-        print("Tentando download com CDN...")
-        self.cdn.download()
-        
-        # Verificar duração novamente
-        duration = self.__check_video_duration()
-        if duration > 10:
-            print(f"Vídeo baixado com sucesso! Duração: {duration:.2f} segundos")
-        else:
-            print("Não foi possível baixar o vídeo de nenhum dos provedores disponíveis.")
+        self.probe()
+        while True:
+            stage = self.fetch()
+            if stage is None:
+                return False
+            if stage == "remux" and not self.remux():
+                continue
+            if self.verify():
+                return True
+
+
+class LessonPipeline:
+    # Cada aula passa por estágios com pools próprios e filas limitadas entre eles, para que
+    # os segmentos de uma aula baixem enquanto o ffmpeg converte outra. O handler de um
+    # estágio recebe o job e retorna o próximo estágio, ou None quando a aula terminou.
+    def __init__(self, stages: list, finish, queue_size: int = PIPELINE_QUEUE_SIZE):
+        # stages: [(nome, handler, workers)] na ordem do fluxo; finish(job, erro) fecha a aula
+        self.order = [name for name, _, _ in stages]
+        self.handlers = {name: handler for name, handler, _ in stages}
+        self.queues = {name: queue.Queue(maxsize=max(1, queue_size)) for name in self.order}
+        self.finish = finish
+        self.pending = 0
+        self.done = 0
+        self.total = 0
+        self.condition = threading.Condition()
+        self.threads = []
+        for name, _, workers in stages:
+            for number in range(max(1, workers)):
+                thread = threading.Thread(target=self._worker, args=(name,), name=f"{name}-{number}", daemon=True)
+                thread.start()
+                self.threads.append((name, thread))
+
+    def submit(self, job):
+        with self.condition:
+            self.pending += 1
+            self.total += 1
+        self.queues[self.order[0]].put(job)
+
+    def _run(self, origin: str, job):
+        # Só bloqueia ao entregar para um estágio depois do estágio deste worker: as esperas
+        # sempre andam para frente e o último estágio nunca espera, então não há deadlock.
+        # Voltar (outro provedor) ou chegar ao próprio estágio depois de rodar outro aqui
+        # nunca bloqueia: com a fila cheia o estágio seguinte roda nesta mesma thread.
+        stage = origin
+        while True:
+            try:
+                with TRACER.span(stage, "pipeline", lesson=job.get("title")):
+                    next_stage = self.handlers[stage](job)
+            except Exception as e:
+                self._close(job, e)
+                return
+            if next_stage is None:
+                self._close(job, None)
+                return
+            if self.order.index(next_stage) > self.order.index(origin):
+                self.queues[next_stage].put(job)
+                return
+            try:
+                self.queues[next_stage].put_nowait(job)
+                return
+            except queue.Full:
+                stage = next_stage
+
+    def _close(self, job, error):
+        try:
+            self.finish(job, error)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.done += 1
+                print(f"\nAulas concluídas: {self.done} de {self.total}")
+                self.condition.notify_all()
+
+    def _worker(self, stage: str):
+        while True:
+            job = self.queues[stage].get()
+            if job is None:
+                return
+            self._run(stage, job)
+
+    def wait(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+        for name, _ in self.threads:
+            self.queues[name].put(None)
+        for _, thread in self.threads:
+            thread.join()
 
 
 class Rocketseat:
-    def __init__(self):
+    def __init__(self, report_label: Optional[str] = None):
         self._session_exists = SESSION_PATH.exists()
         if self._session_exists:
             print("Carregando sessão salva...")
@@ -447,7 +2475,17 @@ class Rocketseat:
                 "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
                 "Referer": BASE_URL,
             })
-        self.download_report = DownloadReport()
+        self.download_report = DownloadReport(report_label)
+        self.metadata = MetadataCache(self.session)
+        self.store = VideoStore()
+        self.index = LessonIndex(store=self.store)
+        self.catalog = CatalogIndex()
+        # --refresh-catalog: ignora o catálogo guardado e busca todas as páginas de novo
+        self.refresh_catalog = False
+        # Materiais de todas as aulas em andamento baixam em paralelo aos vídeos
+        self.attachments = ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS)
+        self.attachment_futures = []
+        self.attachment_downloader = AttachmentDownloader()
 
     def login(self, username: str, password: str):
         print("Realizando login...")
@@ -472,8 +2510,7 @@ class Rocketseat:
         
         # Get modules data from API
         url = f"{BASE_API}/v2/journeys/{specialization_slug}/progress/temp"
-        res = self.session.get(url)
-        res.raise_for_status()
+        progress_text, _ = self.metadata.fetch(url)
 
         modules_data = []
         
@@ -481,23 +2518,21 @@ class Rocketseat:
         # challenge: {slug: 'quiz-formacao-desenvolvimento-ia-estatistica'}
 
         try:
-            progress_data = res.json()
+            progress_data = json.loads(progress_text)
             modules_data = progress_data.get("nodes", [])
 
             journey_url = f"https://app.rocketseat.com.br/journey/{specialization_slug}/contents"
-            html_content = self.session.get(journey_url).text
+            html_content, _ = self.metadata.fetch(journey_url)
+
+            # Os links dos clusters aparecem na página na mesma ordem dos módulos do tipo cluster
+            cluster_slugs = iter(re.findall(r'<a class="w-full" href="/classroom/([^"]*)"', html_content))
 
             for module in modules_data:
                 if module.get("type") == "cluster":
-                    search_pattern = f'<a class="w-full" href="/classroom/'
-                    html_pos = html_content.find(search_pattern)
-                    if html_pos != -1:
-                        start_pos = html_pos + len(search_pattern)
-                        end_pos = html_content.find('"', start_pos)
-                        cluster_slug = html_content[start_pos:end_pos]
+                    cluster_slug = next(cluster_slugs, None)
+                    if cluster_slug is not None:
                         print(f"Encontrado cluster_slug para módulo {module['title']}: {cluster_slug}")
                         module["cluster_slug"] = cluster_slug
-                        html_content = html_content[end_pos:]
                     else:
                         print(f"Não encontrado cluster_slug para módulo {module['title']}")
                         module["cluster_slug"] = None
@@ -519,15 +2554,12 @@ class Rocketseat:
         url = f"{BASE_API}/journey-nodes/{cluster_slug}"
         
         try:
-            res = self.session.get(url)
-            res.raise_for_status()
-            
-            module_data = res.json()
-            print(f"Resposta da API para o cluster {cluster_slug}:")
-            print(json.dumps(module_data, indent=2))
+            with TRACER.span("cluster", "api", cluster=cluster_slug):
+                module_text, changed = self.metadata.fetch(url)
+            module_data = json.loads(module_text)
             
-            # Salva estrutura para debug se diretório logs existir
-            if os.path.exists("logs"):
+            # Salva estrutura para debug se diretório logs existir (só quando veio da rede)
+            if changed and os.path.exists("logs"):
                 with open(f"logs/{sanitize_string(cluster_slug)}_cluster_details.json", "w") as f:
                     json.dump(module_data, f, indent=2)
             
@@ -563,92 +2595,285 @@ class Rocketseat:
     def _download_video(self, video_id: str, save_path: Path):
         VideoDownloader(video_id, str(save_path / "aulinha.mp4")).download()
 
-    def _download_lesson(self, lesson: dict, save_path: Path, group_index: int, lesson_index: int):
-        if isinstance(lesson, dict) and 'title' in lesson:
-            title = lesson.get('title', 'Sem título')
-            group_title = lesson.get('group_title', 'Sem Grupo')
-            print(f"\tBaixando aula {group_index}.{lesson_index}: {title} (Grupo: {group_title})")
+    def _stage_metadata(self, job: dict) -> Optional[str]:
+        lesson = job["lesson"]
+        title = job["title"]
+        group_title = job["group_title"]
+        print(f"\tBaixando aula {job['group_index']}.{job['lesson_index']}: {title} (Grupo: {group_title})")
+        metrics = job["metrics"] = METRICS.start_lesson(group_title, title)
+
+        # Criar pasta do grupo se não existir
+        base_path = lesson_base_path(job["save_path"], job["group_index"], job["lesson_index"], lesson)
+        group_folder = base_path.parent
+        group_folder.mkdir(exist_ok=True)
+        
+        # Criar arquivo base com número sequencial do grupo
+        base_name = base_path.name
+        
+        # Salvar metadados em arquivo .txt
+        with open(group_folder / f"{base_name}.txt", "w", encoding="utf-8") as f:
+            f.write(f"Grupo: {group_title}\n")
+            f.write(f"Aula: {title}\n\n")
             
-            try:
-                # Criar pasta do grupo se não existir
-                group_folder = save_path / f"{group_index:02d}. {sanitize_string(group_title)}"
-                group_folder.mkdir(exist_ok=True)
-                
-                # Criar arquivo base com número sequencial do grupo
-                base_name = f"{lesson_index:02d}. {sanitize_string(title)}"
-                
-                # Salvar metadados em arquivo .txt
-                with open(group_folder / f"{base_name}.txt", "w", encoding="utf-8") as f:
-                    f.write(f"Grupo: {group_title}\n")
-                    f.write(f"Aula: {title}\n\n")
-                    
-                    # Adicionar descrição se existir
-                    if 'description' in lesson and lesson['description']:
-                        f.write(f"Descrição:\n{lesson['description']}\n\n")
-                    
-                    # Adicionar outras informações se existirem
-                    if 'duration' in lesson:
-                        minutes = lesson['duration'] // 60
-                        seconds = lesson['duration'] % 60
-                        f.write(f"Duração: {minutes}min {seconds}s\n")
-                    
-                    if 'author' in lesson and lesson['author'] and isinstance(lesson['author'], dict):
-                        author_name = lesson['author'].get('name', '')
-                        if author_name:
-                            f.write(f"Autor: {author_name}\n")
-                
-                # Baixar o vídeo se tiver resource
-                if 'resource' in lesson and lesson['resource']:
-                    resource = lesson["resource"].split("/")[-1] if "/" in lesson["resource"] else lesson["resource"]
-                    VideoDownloader(resource, str(group_folder / f"{base_name}.mp4")).download()
-                    self.download_report.add_success(group_title, title)
-                else:
-                    print(f"\tAula '{title}' não tem recurso de vídeo")
-                    self.download_report.add_success(group_title, title)  # Considera sucesso mesmo sem vídeo
-                
-                # Baixar arquivos adicionais
-                if 'downloads' in lesson and lesson['downloads']:
-                    downloads_dir = group_folder / f"{base_name}_arquivos"
-                    downloads_dir.mkdir(exist_ok=True)
-                    
-                    for download in lesson['downloads']:
-                        if 'file_url' in download and download['file_url']:
-                            download_url = download['file_url']
-                            download_title = download.get('title', 'arquivo')
-                            file_ext = os.path.splitext(download_url)[1]
-                            
-                            download_path = downloads_dir / f"{sanitize_string(download_title)}{file_ext}"
-                            print(f"\t\tBaixando material: {download_title}")
-                            
-                            try:
-                                response = requests.get(download_url)
-                                response.raise_for_status()
-                                
-                                with open(download_path, 'wb') as f:
-                                    f.write(response.content)
-                                    
-                                print(f"\t\tMaterial salvo em: {download_path}")
-                            except Exception as e:
-                                print(f"\t\tErro ao baixar material: {e}")
-            except Exception as e:
-                self.download_report.add_failure(group_title, title, e)
-                print(f"\tErro ao baixar aula: {str(e)}")
-        else:
+            # Adicionar descrição se existir
+            if 'description' in lesson and lesson['description']:
+                f.write(f"Descrição:\n{lesson['description']}\n\n")
+            
+            # Adicionar outras informações se existirem
+            if 'duration' in lesson:
+                minutes = lesson['duration'] // 60
+                seconds = lesson['duration'] % 60
+                f.write(f"Duração: {minutes}min {seconds}s\n")
+            
+            if 'author' in lesson and lesson['author'] and isinstance(lesson['author'], dict):
+                author_name = lesson['author'].get('name', '')
+                if author_name:
+                    f.write(f"Autor: {author_name}\n")
+        
+        # Estágio de materiais: começam a baixar antes do vídeo, sem esperar por ele
+        if 'downloads' in lesson and lesson['downloads']:
+            downloads_dir = group_folder / f"{base_name}_arquivos"
+            downloads_dir.mkdir(exist_ok=True)
+            for download in lesson['downloads']:
+                if 'file_url' in download and download['file_url']:
+                    with job["lock"]:
+                        job["open"] += 1
+                    future = self.attachments.submit(self._download_attachment, download, downloads_dir, job)
+                    future.add_done_callback(lambda _, job=job: self._release_lesson(job))
+                    self.attachment_futures.append(future)
+        
+        # Baixar o vídeo se tiver resource
+        job["target"] = lesson_target_path(base_path, lesson)
+        if 'resource' in lesson and lesson['resource']:
+            save_path = job["target"]
+            duration = None
+            if job["target"].exists():
+                # O índice não conhece este arquivo (senão a aula nem estaria no plano): pode ser
+                # um .mp4 truncado de uma versão antiga, então só é aproveitado se o ffprobe confirmar
+                duration = probe_duration(str(job["target"]))
+                if duration is None:
+                    print("\tArquivo já existe (sem ffprobe para conferir). Pulando download.")
+                    job["status"] = "success"
+                    return None
+                if duration <= MIN_VIDEO_DURATION or duration_mismatch(duration, lesson.get('duration')):
+                    # Baixa ao lado e só troca depois de verificado: se nenhum provedor servir,
+                    # o arquivo antigo continua lá
+                    print(f"\tArquivo existente com {duration:.0f}s. Baixando de novo.")
+                    save_path = job["target"].with_name(f"{job['target'].stem}.novo{job['target'].suffix}")
+                    duration = None
+            downloader = VideoDownloader(lesson_resource(lesson), str(save_path), metrics=metrics,
+                                         expected_duration=lesson.get('duration'))
+            job["downloader"] = downloader
+            if duration is not None:
+                print("\tArquivo já existe. Pulando download.")
+                downloader.duration = duration
+                return "verify"
+            stored = self.store.reserve(downloader.video_id, lesson.get("updated_at"))
+            if stored is not None:
+                # Vídeo já baixado por outra aula (de qualquer formação): só liga o arquivo
+                self.store.link(stored, job["target"])
+                print(f"\tVídeo {downloader.video_id} reaproveitado do store ({stored['provider']})")
+                job["duration"] = stored["duration"]
+                job["status"] = "success"
+                return None
+            job["store_owner"] = True
+            return "fetch" if downloader.probe() else self._video_failed(job)
+
+        print(f"\tAula '{title}' não tem recurso de vídeo")
+        job["status"] = "success"  # Considera sucesso mesmo sem vídeo
+        return None
+
+    def _stage_fetch(self, job: dict) -> Optional[str]:
+        return job["downloader"].fetch() or self._video_failed(job)
+
+    def _stage_remux(self, job: dict) -> Optional[str]:
+        # Conversão falhou: tenta o próximo provedor, se houver
+        return "verify" if job["downloader"].remux() else "fetch"
+
+    def _stage_verify(self, job: dict) -> Optional[str]:
+        downloader = job["downloader"]
+        if downloader.verify():
+            if downloader.save_path != str(job["target"]):
+                # Download novo verificado: agora sim substitui o arquivo que já existia
+                os.replace(downloader.save_path, job["target"])
+            self.store.add(downloader.provider or "local", downloader.video_id, job["target"], downloader.duration,
+                           job["lesson"].get("updated_at"))
+            job["duration"] = downloader.duration
+            job["status"] = "success"
+            return None
+        if not downloader.probes:
+            # Arquivo que já existia não passou na verificação: só agora os provedores são sondados
+            downloader.probe()
+        return "fetch"
+
+    def _video_failed(self, job: dict) -> None:
+        resource = lesson_resource(job["lesson"])
+        self.download_report.add_failure(job["group_title"], job["title"], f"vídeo {resource} indisponível nos provedores")
+        return None
+
+    def _finish_lesson(self, job: dict, error: Optional[Exception]):
+        if job["store_owner"]:
+            # Libera as aulas que esperavam por este vídeo, tenha ele dado certo ou não
+            self.store.done(job["downloader"].video_id)
+        if error is not None:
+            self.download_report.add_failure(job["group_title"], job["title"], error)
+            print(f"\tErro ao baixar aula: {str(error)}")
+        self._release_lesson(job)
+
+    def _release_lesson(self, job: dict):
+        # A aula só entra no índice e no relatório quando o vídeo e todos os materiais
+        # terminaram: com material faltando ela fica fora do índice e volta no próximo plano
+        with job["lock"]:
+            job["open"] -= 1
+            if job["open"]:
+                return
+        if job["status"] == "success":
+            if job["attachment_errors"]:
+                job["status"] = "failure"
+                self.download_report.add_failure(job["group_title"], job["title"],
+                                                 f"materiais não baixados: {'; '.join(job['attachment_errors'])}")
+            else:
+                self.index.record(job["lesson"], job["target"], job["duration"])
+                self.download_report.add_success(job["group_title"], job["title"])
+        self.index.release(job["lesson"])
+        if job["metrics"] is not None:
+            METRICS.finish_lesson(job["metrics"], job["status"])
+
+    def _lesson_job(self, lesson: dict, save_path: Path, group_index: int, lesson_index: int) -> Optional[dict]:
+        if not (isinstance(lesson, dict) and 'title' in lesson):
             print(f"\tFormato de aula não reconhecido: {lesson}")
+            return None
+        title = lesson.get('title', 'Sem título')
+        group_title = lesson.get('group_title', 'Sem Grupo')
+        return {
+            "lesson": lesson,
+            "save_path": save_path,
+            "group_index": group_index,
+            "lesson_index": lesson_index,
+            "title": title,
+            "group_title": group_title,
+            "metrics": None,
+            "status": "failure",
+            "target": None,
+            "downloader": None,
+            # Duração do vídeo para o índice e erros dos materiais, gravados quando a aula fecha
+            "duration": None,
+            "attachment_errors": [],
+            # Esta aula é quem baixa o vídeo para o store neste processo
+            "store_owner": False,
+            # Partes ainda abertas da aula: o vídeo e cada material
+            "open": 1,
+            "lock": threading.Lock(),
+        }
+
+    def _lesson_pipeline(self) -> LessonPipeline:
+        return LessonPipeline(
+            [
+                ("metadata", self._stage_metadata, METADATA_WORKERS),
+                ("fetch", self._stage_fetch, LESSON_WORKERS),
+                ("remux", self._stage_remux, REMUX_WORKERS),
+                ("verify", self._stage_verify, VERIFY_WORKERS),
+            ],
+            self._finish_lesson,
+        )
 
-    def _download_courses(self, specialization_slug: str, specialization_name: str):
+    def _download_attachment(self, download: dict, downloads_dir: Path, job: dict):
+        metrics = job["metrics"]
+        download_url = download['file_url']
+        download_title = download.get('title', 'arquivo')
+        file_ext = os.path.splitext(urlparse(download_url).path)[1]
+        
+        download_path = downloads_dir / f"{sanitize_string(download_title)}{file_ext}"
+        print(f"\t\tBaixando material: {download_title}")
+        
+        try:
+            with TRACER.span("attachment", "attachment", lesson=metrics.lesson, host=urlparse(download_url).netloc,
+                             file=download_path.name) as trace:
+                size = trace["bytes"] = self.attachment_downloader.download(
+                    download_url, download_path, on_chunk=BANDWIDTH.consume)
+            metrics.add_attachment(size)
+            print(f"\t\tMaterial salvo em: {download_path}")
+        except Exception as e:
+            print(f"\t\tErro ao baixar material: {e}")
+            job["attachment_errors"].append(f"{download_title}: {e}")
+
+    def __build_plan(self, modules: list, specialization_name: str):
+        # Busca todos os clusters selecionados em paralelo e monta a lista completa de
+        # aulas a baixar (lesson, save_path, group_index, lesson_index) antes de qualquer vídeo.
+        # Retorna (plano, aulas cujo vídeo outro processo do batch está baixando).
+        cluster_modules = []
+        for module in modules:
+            if module.get("cluster_slug"):
+                cluster_modules.append(module)
+            else:
+                print(f"Módulo não possui cluster_slug: {module['title']}. Pulando.")
+
+        slugs = [module["cluster_slug"] for module in cluster_modules]
+        print(f"Buscando {len(slugs)} clusters...")
+        with ThreadPoolExecutor(max_workers=max(1, CLUSTER_FETCH_LIMIT)) as executor:
+            groups_by_slug = dict(zip(slugs, executor.map(self.__load_lessons_from_cluster, slugs)))
+
+        plan = []
+        waiting = []
+        plan_counts = collections.Counter()
+        for module in cluster_modules:
+            module_title = module["title"]
+            course_name = module.get("course", {}).get("title", "Sem Nome")
+            groups = groups_by_slug[module["cluster_slug"]]
+            if not groups:
+                print(f"Nenhum grupo encontrado para o módulo: {module_title}")
+                continue
+
+            save_path = Path("Cursos") / specialization_name / sanitize_string(course_name) / sanitize_string(module_title)
+            save_path.mkdir(parents=True, exist_ok=True)
+
+            # A numeração é fixada aqui para manter a ordem "NN. Grupo/NN. Aula" mesmo com
+            # execução paralela; o índice local decide o que precisa ser baixado
+            for group_index, group in enumerate(groups, 1):
+                for lesson_index, lesson in enumerate(group["lessons"], 1):
+                    claimed = self.index.claim(lesson)
+                    base_path = lesson_base_path(save_path, group_index, lesson_index, lesson)
+                    status = self.index.plan(lesson, lesson_target_path(base_path, lesson))
+                    plan_counts[status] += 1
+                    if status in ("ok", "moved"):
+                        if claimed:
+                            self.index.release(lesson)
+                    elif claimed:
+                        plan.append((lesson, save_path, group_index, lesson_index))
+                    else:
+                        # Outro processo (modo batch) está baixando o vídeo: esta aula espera
+                        # por ele e depois só liga o arquivo do store
+                        plan_counts["claimed"] += 1
+                        waiting.append((lesson, save_path, group_index, lesson_index))
+
+        self.download_report.add_skipped(plan_counts["ok"] + plan_counts["moved"])
+        print(
+            f"\nPlano de download: {len(plan)} aulas em {len(cluster_modules)} módulos | "
+            f"{plan_counts['new']} novas, {plan_counts['changed']} alteradas, {plan_counts['broken']} incompletas, "
+            f"{plan_counts['moved']} renomeadas, {plan_counts['ok']} em dia, "
+            f"{plan_counts['claimed']} aguardando vídeo de outro processo"
+        )
+        return plan, waiting
+
+    def _download_courses(self, specialization_slug: str, specialization_name: str,
+                          module_selection: Optional[list] = None):
+        # module_selection: números dos módulos (a partir de 1); vazio baixa todos e None pergunta
         print(f"Baixando cursos da especialização: {specialization_name}")
         self.download_report.start()
+        pipeline = self._lesson_pipeline()
         
         try:
             modules = self.__load_modules(specialization_slug)
 
-            print("\nEscolha os módulos que você quer baixar:")
-            print("[0] - Baixar todos os módulos")
-            for i, module in enumerate(modules, 1):
-                print(f"[{i}] - {module['title']}")
+            if module_selection is None:
+                print("\nEscolha os módulos que você quer baixar:")
+                print("[0] - Baixar todos os módulos")
+                for i, module in enumerate(modules, 1):
+                    print(f"[{i}] - {module['title']}")
 
-            choices = input("Digite 0 para baixar todos os módulos ou os números dos módulos separados por vírgula (ex: 1, 3, 5): ")
+                choices = input("Digite 0 para baixar todos os módulos ou os números dos módulos separados por vírgula (ex: 1, 3, 5): ")
+            else:
+                choices = ",".join(str(number) for number in module_selection) or "0"
             
             if choices.strip() == "0":
                 selected_modules = modules
@@ -656,59 +2881,107 @@ class Rocketseat:
             else:
                 selected_modules = [modules[int(choice.strip()) - 1] for choice in choices.split(",")]
 
-            for module in selected_modules:
-                module_title = module["title"]
-                course_name = module.get("course", {}).get("title", "Sem Nome")
-                print(f"\nBaixando módulo: {module_title} do curso: {course_name}")
-                save_path = Path("Cursos") / specialization_name / sanitize_string(course_name) / sanitize_string(module_title)
-                save_path.mkdir(parents=True, exist_ok=True)
-
-                # Verifica se o módulo tem um cluster_slug
-                if "cluster_slug" in module and module["cluster_slug"]:
-                    cluster_slug = module["cluster_slug"]
-                    print(f"Usando cluster_slug: {cluster_slug}")
-                    
-                    # Obter grupos e aulas a partir do cluster_slug
-                    groups = self.__load_lessons_from_cluster(cluster_slug)
-                    
-                    if not groups:
-                        print(f"Nenhum grupo encontrado para o módulo: {module_title}")
-                        continue
-                    
-                    # Baixa cada grupo sequencialmente
-                    for group_index, group in enumerate(groups, 1):
-                        group_title = group["title"]
-                        print(f"\nProcessando grupo {group_index}: {group_title}")
-                        
-                        # Baixa cada aula do grupo
-                        for lesson_index, lesson in enumerate(group["lessons"], 1):
-                            self._download_lesson(lesson, save_path, group_index, lesson_index)
-                        
-                        print(f"Grupo {group_index} ({group_title}) concluído!")
-                else:
-                    print(f"Módulo não possui cluster_slug: {module_title}. Pulando.")
-                    continue
+            plan, waiting = self.__build_plan(selected_modules, specialization_name)
+            for entry in plan:
+                job = self._lesson_job(*entry)
+                if job is not None:
+                    pipeline.submit(job)
+            if waiting:
+                print(f"\nAguardando outro processo terminar {len(waiting)} vídeos compartilhados...")
+            for entry in waiting:
+                # Só entra no pipeline quando o dono do vídeo termina (ou morre); aí a etapa de
+                # metadados acha o vídeo no store e só cria o link
+                while not self.index.claim(entry[0]):
+                    time.sleep(2)
+                job = self._lesson_job(*entry)
+                if job is not None:
+                    pipeline.submit(job)
         finally:
+            pipeline.wait()
+            for future in self.attachment_futures:
+                future.result()
+            self.attachment_futures = []
+            self.index.release_all()
             self.download_report.finish()
 
-    def select_specializations(self):
-        print("Buscando especializações disponíveis...")
+    def __catalog_page(self, page: int, ttl: int = METADATA_TTL) -> dict:
         params = {
             "types[0]": "SPECIALIZATION",
             "types[1]": "COURSE",
             "types[2]": "EXTRA",
-            "limit": "60",
-            "offset": "0",
-            "page": "1",
+            "limit": str(CATALOG_PAGE_SIZE),
+            "offset": str((page - 1) * CATALOG_PAGE_SIZE),
+            "page": str(page),
             "sort_by": "relevance",
         }
-        specializations = self.session.get(f"{BASE_API}/catalog/list", params=params).json()["items"]
-        clear_screen()
-        print("Selecione uma formação ou 0 para selecionar todas:")
-        for i, specialization in enumerate(specializations, 1):
-            print(f"[{i}] - {specialization['title']}")
+        return self.metadata.get_json(f"{BASE_API}/catalog/list", params, ttl)
+
+    @staticmethod
+    def __catalog_total(data: dict) -> Optional[int]:
+        for container in (data, data.get("meta") or {}, data.get("pagination") or {}):
+            for field in ("total", "count", "totalItems", "total_items"):
+                if isinstance(container.get(field), int):
+                    return container[field]
+        return None
+
+    def _load_catalog(self, refresh: bool = False) -> list:
+        # Catálogo conhecido e dentro do TTL (ou modo offline): vem do índice, sem rede
+        synced_at = self.catalog.synced_at()
+        if not refresh and synced_at is not None and (OFFLINE or time.time() - synced_at < CATALOG_TTL):
+            return self.catalog.search()
+
+        print("Buscando especializações disponíveis...")
+        # --refresh-catalog revalida cada página na API (com ETag) em vez de usar o cache de metadados
+        fetch_page = functools.partial(self.__catalog_page, ttl=0 if refresh else METADATA_TTL)
+        first = fetch_page(1)
+        items = list(first["items"])
+        total = self.__catalog_total(first)
+        with ThreadPoolExecutor(max_workers=max(1, CLUSTER_FETCH_LIMIT)) as executor:
+            if total is not None:
+                # Total conhecido: todas as páginas restantes de uma vez
+                pages = range(2, -(-total // CATALOG_PAGE_SIZE) + 1)
+                for data in executor.map(fetch_page, pages):
+                    items.extend(data["items"])
+            else:
+                # Sem total na resposta: lotes de páginas em paralelo até vir uma página incompleta
+                page = 2
+                last_size = len(first["items"])
+                while last_size >= CATALOG_PAGE_SIZE:
+                    batch = range(page, page + max(1, CLUSTER_FETCH_LIMIT))
+                    for data in executor.map(fetch_page, batch):
+                        if last_size < CATALOG_PAGE_SIZE:
+                            break
+                        items.extend(data["items"])
+                        last_size = len(data["items"])
+                    page = batch[-1] + 1
+
+        unique = {}
+        for item in items:
+            unique.setdefault(item["slug"], item)
+        unique = list(unique.values())
+        self.catalog.replace(unique)
+        print(f"Catálogo atualizado: {len(unique)} itens")
+        return self.catalog.search()
 
-        choice = int(input(">> "))
+    def select_specializations(self):
+        specializations = self._load_catalog(self.refresh_catalog)
+        clear_screen()
+        while True:
+            print("Selecione uma formação ou 0 para selecionar todas as listadas.")
+            print("Digite parte do nome para filtrar, ou Enter para ver o catálogo inteiro:")
+            for i, specialization in enumerate(specializations, 1):
+                print(f"[{i}] - {specialization['title']}")
+
+            answer = input(">> ").strip()
+            if answer.isdigit():
+                break
+            specializations = self.catalog.search(answer)
+            clear_screen()
+            if not specializations:
+                print(f"Nada encontrado para '{answer}'.")
+                specializations = self.catalog.search()
+
+        choice = int(answer)
         if choice == 0:
             for specialization in specializations:
                 self._download_courses(specialization["slug"], specialization["title"])
@@ -716,6 +2989,58 @@ class Rocketseat:
             specialization = specializations[choice - 1]
             self._download_courses(specialization["slug"], specialization["title"])
 
+    def _batch_tasks(self, jobs: list, shard: str) -> list:
+        # jobs: [{"specialization": slug ou "all", "modules": [números]}]. Cada tarefa vira
+        # uma formação inteira ou, com shard="module", um único módulo.
+        catalog = {item["slug"]: item["title"] for item in self._load_catalog(self.refresh_catalog)}
+        selected = []
+        for job in jobs:
+            if job["specialization"] == "all":
+                selected.extend((slug, []) for slug in catalog)
+            else:
+                if job["specialization"] not in catalog:
+                    print(f"Formação {job['specialization']} não está no catálogo; usando o slug como nome.")
+                selected.append((job["specialization"], list(job.get("modules") or [])))
+
+        tasks = []
+        for slug, modules in selected:
+            title = catalog.get(slug, slug)
+            if shard == "module":
+                numbers = modules or range(1, len(self.__load_modules(slug)) + 1)
+                tasks.extend(
+                    {"slug": slug, "title": title, "modules": [number], "label": f"{slug}_{number}"}
+                    for number in numbers
+                )
+            else:
+                tasks.append({"slug": slug, "title": title, "modules": modules, "label": slug})
+        return tasks
+
+    def batch(self, jobs: list, processes: int = BATCH_PROCESSES, shard: str = "specialization"):
+        # Modo não interativo: distribui as tarefas entre processos. O índice local garante
+        # que duas tarefas com a mesma aula não a baixem duas vezes.
+        tasks = self._batch_tasks(jobs, shard)
+        processes = max(1, min(processes, len(tasks)))
+        print(f"{len(tasks)} tarefas em {processes} processos")
+        totals = collections.Counter()
+        # spawn: cada processo começa limpo, sem herdar conexões ou threads deste
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+            futures = {executor.submit(run_batch_task, task, processes): task for task in tasks}
+            for done, future in enumerate(as_completed(futures), 1):
+                task = futures[future]
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    totals["failed_tasks"] += 1
+                    print(f"\nTarefa {task['label']} falhou: {e}")
+                    continue
+                totals.update(summary)
+                print(f"\nTarefas concluídas: {done} de {len(tasks)} ({task['label']})")
+        print(
+            f"\nBatch concluído: {totals['success']} aulas baixadas, {totals['failure']} com erro, "
+            f"{totals['skipped']} já sincronizadas, {totals['failed_tasks']} tarefas com falha"
+        )
+
     def run(self):
         if not self._session_exists:
             self.login(
@@ -725,7 +3050,74 @@ class Rocketseat:
         self.select_specializations()
 
 
+def run_batch_task(task: dict, processes: int) -> dict:
+    # Executa uma tarefa do batch dentro de um processo do pool, com a sessão do .session.pkl
+    global METRICS
+    BANDWIDTH.share = processes
+    if TRACE_FILE:
+        trace_path = Path(TRACE_FILE)
+        TRACER.path = str(trace_path.with_name(f"{trace_path.stem}_{task['label']}{trace_path.suffix}"))
+    # Métricas novas a cada tarefa: um processo do pool pode rodar várias
+    METRICS = RunMetrics()
+    if METRICS.textfile:
+        # Um textfile por tarefa: com um só, o último processo a gravar apagaria os outros
+        METRICS.textfile = METRICS.textfile.with_name(f"{Path(METRICS_TEXTFILE).stem}_{task['label']}.prom")
+        METRICS.label = task["label"]
+    agent = Rocketseat(report_label=task["label"])
+    try:
+        agent._download_courses(task["slug"], task["title"], task["modules"])
+    finally:
+        # Os processos do pool terminam sem rodar o atexit
+        TRACER.save()
+        STAGING.spill_all()
+    report = agent.download_report
+    return {
+        "success": len(report.successful_downloads),
+        "failure": len(report.failed_downloads),
+        "skipped": report.skipped_downloads,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download das aulas da Rocketseat")
+    parser.add_argument("--batch", action="store_true", help="modo não interativo, com vários processos")
+    parser.add_argument("--specializations", default="",
+                        help='slugs separados por vírgula, ou "all" para o catálogo inteiro')
+    parser.add_argument("--modules", default="", help="números dos módulos (ex: 1,3,5); vale para todas as formações")
+    parser.add_argument("--job-file", help='JSON com [{"specialization": "slug", "modules": [1, 2]}, ...]')
+    parser.add_argument("--processes", type=int, default=BATCH_PROCESSES)
+    parser.add_argument("--shard", choices=("specialization", "module"), default="specialization",
+                        help="unidade de trabalho de cada processo")
+    parser.add_argument("--refresh-catalog", action="store_true", help="busca o catálogo na API mesmo dentro do CATALOG_TTL")
+    parser.add_argument("--prune-store", action="store_true", help="apaga do store os vídeos que nenhuma aula usa e sai")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
     print("Iniciando o processo de download...")
     agent = Rocketseat()
-    agent.run()
+    agent.refresh_catalog = args.refresh_catalog
+    if args.prune_store:
+        removed, freed = agent.store.prune()
+        print(f"Store: {removed} vídeos sem uso removidos, {freed / 1e9:.2f} GB liberados")
+    elif not args.batch:
+        agent.run()
+    else:
+        if not SESSION_PATH.exists():
+            # Login uma única vez; os processos do batch reaproveitam o .session.pkl
+            agent.login(
+                username=os.getenv("ROCKETSEAT_EMAIL") or input("Seu email Rocketseat: "),
+                password=os.getenv("ROCKETSEAT_PASSWORD") or input("Sua senha: "),
+            )
+        if args.job_file:
+            jobs = json.loads(Path(args.job_file).read_text(encoding="utf-8"))
+        else:
+            modules = [int(number) for number in args.modules.split(",") if number.strip()]
+            jobs = [
+                {"specialization": slug.strip(), "modules": modules}
+                for slug in args.specializations.split(",") if slug.strip()
+            ]
+        if not jobs:
+            raise SystemExit("Informe --specializations ou --job-file no modo --batch")
+        agent.batch(jobs, args.processes, args.shard)